@@ -0,0 +1,235 @@
+import argparse
+import os
+import json
+import subprocess
+from datetime import datetime
+import data_validation
+from generate_data import (generate_file, synthetic_filename)
+from stage_metrics import StageMetrics
+from helper_utils import (LoggerClass, set_run_logger, get_file_date)
+from config import *
+
+
+# Times every data_validation stage, and optionally the data_to_postgredb load, on synthetic files
+# of increasing size. One record per stage and run is appended to results.jsonl under benchmark_path,
+# and each run is compared with the previous run of the same size and settings.
+#
+# The load runs against the database in db_config (point SNOOP_DB_* at a throwaway local Postgres)
+# and is rolled back afterwards, so every run loads into the same, empty tables.
+
+SETTINGS = ["chunk_size", "compact_schema", "use_copy_loader", "copy_batch_rows", "parallel_load_workers"]
+
+
+def current_commit():
+    """
+    Returns the short hash of the checked out commit, or None outside a git repository.
+    """
+
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def prepare_file(raw_path, rows, params, regenerate = False):
+    """
+    Generates the synthetic file of the given size, unless one generated with the same parameters exists.
+    The parameters are kept in a .params.json file next to it.
+    """
+
+    file = synthetic_filename(rows)
+    params_w_path = os.path.join(raw_path, file.replace(".json", ".params.json"))
+
+    if not regenerate and os.path.exists(params_w_path):
+        with open(params_w_path) as f:
+            if json.load(f) == params:
+                return file
+
+    generate_file(raw_path, file, rows, **params)
+
+    with open(params_w_path, 'w') as f:
+        json.dump(params, f)
+
+    return file
+
+
+def load_rolled_back(file, customers_df, transactions_df, metrics):
+    """
+    Loads customers and transactions over one pooled connection, timing each table, and rolls the transaction back.
+    """
+
+    import data_to_postgredb, known_ids, transaction_state
+    from db_connection import get_connection_pool
+
+    conn_pool = get_connection_pool()
+    conn = conn_pool.getconn()
+
+    try:
+        with metrics.stage("load_customers", rows_in = customers_df.shape[0]) as stage:
+            stage["rows_out"] = data_to_postgredb.customer_SQLtable_update(get_file_date(file), conn, customers_df)
+
+        with metrics.stage("load_transactions", rows_in = transactions_df.shape[0]) as stage:
+            stage["rows_out"] = data_to_postgredb.transaction_SQLtable_update(get_file_date(file), conn, transactions_df)
+
+    finally:
+        conn.rollback()
+        # A parallel load drops its staging table in the transaction just rolled back.
+        data_to_postgredb.drop_leftover_staging_tables(conn, "TRANSACTIONS")
+        conn_pool.putconn(conn)
+        known_ids.discard_known_ids()
+        transaction_state.discard_transaction_state()
+
+
+def benchmark_file(file, load):
+    """
+    Runs the validation stages of run_all (and the load, if requested) on one synthetic file,
+    writing every output under benchmark_path.
+
+    Returns:
+    - List[Dict]: The StageMetrics summary, one record per stage.
+    """
+
+    raw_path, removed_path, output_path = (os.path.join(benchmark_path, name) for name in ("raw_data", "removed_data", "logs"))
+    for path in (removed_path, output_path):
+        os.makedirs(path, exist_ok=True)
+
+    # The same module level logger and metrics run_all sets up, but kept out of logs/.
+    data_validation.Logger = LoggerClass(path = output_path, latest_filename = file)
+    data_validation.Metrics = metrics = StageMetrics(path = output_path, latest_filename = file)
+    set_run_logger(data_validation.Logger)
+
+    try:
+        data_validation.Logger.set_stage("validation")
+        df_v = data_validation.run_all_validation_checks(allowed_currency, file, date_fmt, removed_path, output_path,
+                                                         write_output = False, raw_data_path = raw_path)
+
+        data_validation.Logger.set_stage("final_data")
+        with metrics.stage("create_customers", rows_in = df_v.shape[0]) as stage:
+            customers_df = data_validation.create_customer_df(df_v, file, write_output = False)
+            stage["rows_out"] = customers_df.shape[0]
+        with metrics.stage("create_transactions", rows_in = df_v.shape[0]) as stage:
+            transactions_df = data_validation.create_transactions_df(df_v, file, write_output = False)
+            stage["rows_out"] = transactions_df.shape[0]
+
+        if load:
+            data_validation.Logger.set_stage("load")
+            load_rolled_back(file, customers_df, transactions_df, metrics)
+
+    finally:
+        metrics.write()
+        data_validation.Logger.close()
+        set_run_logger(None)
+
+    return metrics.summary()
+
+
+def read_results(results_w_path):
+
+    if not os.path.exists(results_w_path):
+        return []
+
+    with open(results_w_path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def compare_with_previous(records, previous_results, threshold = benchmark_regression_threshold):
+    """
+    Compares the stage timings of one run with the latest earlier run of the same size and settings.
+
+    Returns:
+    - List[str]: One line per stage, flagged "REGRESSION" when it is more than threshold slower.
+    - int: The number of regressions.
+    """
+
+    first = records[0]
+    same = [r for r in previous_results
+            if r["rows"] == first["rows"] and r["load"] == first["load"] and all(r.get(key) == first[key] for key in SETTINGS)]
+
+    if not same:
+        return [f"{first['rows']:>11,} rows: no previous run to compare with."], 0
+
+    latest = max(same, key=lambda r: r["run"])
+    previous = {r["stage"]: r for r in same if r["run"] == latest["run"]}
+
+    lines, regressions = [f"{first['rows']:>11,} rows: compared with run {latest['run']} (commit {latest['commit']})"], 0
+
+    for record in records:
+
+        before = previous.get(record["stage"])
+        if before is None or before["seconds"] <= 0:
+            continue
+
+        ratio = record["seconds"] / before["seconds"]
+        flag = ""
+        if ratio > 1 + threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+
+        lines.append(f"{'':>11}  {record['stage']:<24}{before['seconds']:9.3f}s -> {record['seconds']:9.3f}s  x{ratio:.2f}{flag}")
+
+    return lines, regressions
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Benchmark validation and loading on synthetic transactions files.")
+    parser.add_argument("--rows", type=int, nargs="+", default=[100_000, 1_000_000, 10_000_000])
+    parser.add_argument("--bad-currency-rate", type=float, default=0.002)
+    parser.add_argument("--bad-date-rate", type=float, default=0.001)
+    parser.add_argument("--duplicate-rate", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--regenerate", action="store_true", help="regenerate the synthetic files even if they exist")
+    parser.add_argument("--load", action="store_true",
+                        help="also time the load into the database in db_config (rolled back afterwards)")
+    parser.add_argument("--fail-on-regression", action="store_true",
+                        help=f"exit with status 1 if a stage is more than {benchmark_regression_threshold:.0%} slower than the previous run")
+    args = parser.parse_args()
+
+    raw_path = os.path.join(benchmark_path, "raw_data")
+    os.makedirs(raw_path, exist_ok=True)
+    results_w_path = os.path.join(benchmark_path, "results.jsonl")
+
+    params = {"bad_currency_rate": args.bad_currency_rate, "bad_date_rate": args.bad_date_rate,
+              "duplicate_rate": args.duplicate_rate, "seed": args.seed}
+    run = datetime.now().isoformat(timespec="seconds")
+    commit = current_commit()
+    settings = {key: globals()[key] for key in SETTINGS}
+
+    previous_results = read_results(results_w_path)
+    total_regressions = 0
+
+    try:
+        # Smallest first: peak RSS is per process, so each figure includes the runs before it.
+        for rows in sorted(args.rows):
+
+            file = prepare_file(raw_path, rows, params, args.regenerate)
+            summary = benchmark_file(file, args.load)
+
+            records = [{"run": run, "commit": commit, "rows": rows, "load": args.load, **settings, **params, **record}
+                       for record in summary]
+
+            with open(results_w_path, 'a') as f:
+                for record in records:
+                    f.write(json.dumps(record) + "\n")
+
+            for record in records:
+                print(f"{rows:>11,} rows  {record['stage']:<24}{record['seconds']:9.3f}s  "
+                      f"{record['rows_per_sec'] or 0:>12,} rows/s  peak RSS {record['peak_rss_mb']} MB")
+
+            lines, regressions = compare_with_previous(records, previous_results)
+            print("\n".join(lines))
+            total_regressions += regressions
+
+    finally:
+        if args.load:
+            from db_connection import close_connection_pool
+            close_connection_pool()
+
+    print(f"Results appended to {results_w_path}.")
+
+    if args.fail_on_regression and total_regressions:
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
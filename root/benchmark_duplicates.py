@@ -0,0 +1,90 @@
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from validation_rules import duplicate_mask
+
+
+def make_transactions(rows, dup_ratio, seed = 0):
+    """
+    Builds a DataFrame with the transactionId and sourceDate columns of a raw file, where dup_ratio
+    of the rows repeat an earlier transactionId with a different sourceDate.
+    """
+
+    rng = np.random.default_rng(seed)
+
+    unique_ids = max(1, int(rows * (1 - dup_ratio)))
+    ids = np.concatenate([np.arange(unique_ids), rng.integers(0, unique_ids, rows - unique_ids)])
+    rng.shuffle(ids)
+
+    seconds = rng.integers(1_577_836_800, 1_704_067_200, rows).astype("datetime64[s]")
+
+    return pd.DataFrame({
+        "transactionId": np.char.mod("%032x", ids),
+        "sourceDate": np.datetime_as_string(seconds, unit = "s"),
+    })
+
+
+def legacy_handle_duplicates(df):
+    """
+    The previous handle_duplicates: sorts every duplicate and the whole frame, and finds the removed
+    rows with a cell-wise isin(...).any(axis=1). Kept here only as the benchmark baseline.
+    """
+
+    df_all_duplicates_only = df[df.duplicated(subset = ["transactionId"], keep=False)].copy()
+    df_all_duplicates_only['sourceDate'] = pd.to_datetime(df_all_duplicates_only['sourceDate'], errors='coerce')
+
+    df_latest_dup_entry = df_all_duplicates_only.sort_values(by = ['transactionId',"sourceDate"], ascending=True)
+    df_latest_dup_entry = df_latest_dup_entry.drop_duplicates(subset = ["transactionId"], keep="last")
+
+    df_removed_duplicates = df_all_duplicates_only[~df_all_duplicates_only.isin(df_latest_dup_entry).any(axis=1)]
+
+    df = df.copy()
+    df['sourceDate'] = pd.to_datetime(df['sourceDate'], errors='coerce')
+    df = df.sort_values(by = ['transactionId',"sourceDate"], ascending=True)
+    df = df.drop_duplicates(subset = ["transactionId"], keep="last")
+
+    return df, df_removed_duplicates
+
+
+def time_call(function, *args):
+
+    start = time.perf_counter()
+    result = function(*args)
+    return result, time.perf_counter() - start
+
+
+def run_benchmark(rows, dup_ratio, legacy_max_rows):
+
+    df = make_transactions(rows, dup_ratio)
+
+    mask, elapsed = time_call(duplicate_mask, df)
+    print(f"{rows:>11,} rows, dup ratio {dup_ratio:.2f}: duplicate_mask          {elapsed:8.2f}s "
+          f"({rows / elapsed:,.0f} rows/s), {int(mask.sum()):,} removed")
+
+    if rows > legacy_max_rows:
+        return
+
+    (legacy_kept, legacy_removed), legacy_elapsed = time_call(legacy_handle_duplicates, df)
+    print(f"{rows:>11,} rows, dup ratio {dup_ratio:.2f}: legacy handle_duplicates {legacy_elapsed:8.2f}s "
+          f"({rows / legacy_elapsed:,.0f} rows/s), {legacy_removed.shape[0]:,} removed, "
+          f"speed-up x{legacy_elapsed / elapsed:.1f}")
+
+    # Both must keep the same (transactionId, latest sourceDate) pairs.
+    kept = df[~mask.to_numpy()]
+    kept_pairs = set(zip(kept["transactionId"], pd.to_datetime(kept["sourceDate"])))
+    legacy_pairs = set(zip(legacy_kept["transactionId"], legacy_kept["sourceDate"]))
+    print(f"{'':>11}  kept rows identical to legacy: {kept_pairs == legacy_pairs}")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark duplicate resolution against the previous handle_duplicates.")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1_000_000, 10_000_000])
+    parser.add_argument("--dup-ratio", type=float, default=0.5, help="share of rows repeating an earlier transactionId")
+    parser.add_argument("--legacy-max-rows", type=int, default=1_000_000,
+                        help="skip the (slow, memory hungry) legacy implementation above this many rows")
+    args = parser.parse_args()
+
+    for rows in args.rows:
+        run_benchmark(rows, args.dup_ratio, args.legacy_max_rows)
@@ -0,0 +1,276 @@
+import numpy as np
+import pandas as pd
+from typing import FrozenSet, List, Optional, Tuple
+from pandas.api.types import union_categoricals
+from date_parsing import parse_dates
+
+
+# Compact in-memory representation of the raw transactions, used when compact_schema is set in config.py.
+#  - customerId/transactionId: 128-bit UUIDs stored as two uint64 columns (<name>_hi, <name>_lo). Only lowercase
+#    canonical UUIDs are taken, as they are the ones converted back byte for byte.
+#  - amount: int64 minor units (pennies/cents) in an 'amountMinor' column, if written with two decimals.
+#  - currency, customerName, description, transactionDate: categoricals.
+#  - sourceDate: datetime64, if written in SOURCE_DATE_FORMAT.
+#  - merchantId/categoryId: the smallest integer type that holds them.
+# A column is left as it is if any of its values cannot be represented exactly.
+# A file is processed in one layout, fixed by its first chunk (see to_compact_schema). If a later chunk has a value
+# the layout cannot represent, the rest of the file is processed in the regular representation, and concat_frames
+# converts the compact chunks back when they meet regular ones.
+
+UUID_COLUMNS = ["customerId", "transactionId"]
+CATEGORICAL_COLUMNS = ["currency", "customerName", "description", "transactionDate"]
+INTEGER_COLUMNS = ["merchantId", "categoryId"]
+SOURCE_DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+AMOUNT_SCALE = 100
+
+UUID_HYPHEN_POSITIONS = [8, 13, 18, 23]
+UUID_HEX_POSITIONS = [i for i in range(36) if i not in UUID_HYPHEN_POSITIONS]
+
+HEX_DIGITS = np.frombuffer(b"0123456789abcdef", dtype=np.uint8)
+HEX_VALUES = np.full(256, 255, dtype=np.uint8)
+HEX_VALUES[HEX_DIGITS] = np.arange(16)
+
+NIBBLE_WEIGHTS = np.uint64(16) ** np.arange(15, -1, -1, dtype=np.uint64)
+NIBBLE_SHIFTS = np.arange(60, -4, -4, dtype=np.uint64)
+
+
+def uuid_to_pair(values: pd.Series) -> Optional[Tuple[np.ndarray, np.ndarray]]:
+    """
+    Converts canonical UUID strings to their high and low 64 bits, without a Python level loop.
+    Uppercase hex digits are not accepted, so pair_to_uuid gives back exactly the same strings.
+
+    Parameters:
+    - values (pd.Series): The UUID strings.
+
+    Returns:
+    - Tuple[np.ndarray, np.ndarray]: The high and low uint64 halves, or None if any value is not a lowercase canonical UUID.
+    """
+
+    if not (values.str.len() == 36).all():
+        return None
+
+    try:
+        raw = np.asarray(values.to_numpy(), dtype="S36")
+    except UnicodeEncodeError:
+        return None
+
+    chars = raw.view(np.uint8).reshape(-1, 36)
+    if not (chars[:, UUID_HYPHEN_POSITIONS] == ord("-")).all():
+        return None
+
+    nibbles = HEX_VALUES[chars[:, UUID_HEX_POSITIONS]]
+    if (nibbles == 255).any():
+        return None
+
+    nibbles = nibbles.astype(np.uint64)
+
+    return (nibbles[:, :16] * NIBBLE_WEIGHTS).sum(axis=1), (nibbles[:, 16:] * NIBBLE_WEIGHTS).sum(axis=1)
+
+
+def pair_to_uuid(hi: np.ndarray, lo: np.ndarray) -> np.ndarray:
+    """
+    Converts high and low uint64 halves back to canonical lowercase UUID strings.
+    """
+
+    nibbles = np.empty((hi.shape[0], 32), dtype=np.uint8)
+    nibbles[:, :16] = (hi[:, None] >> NIBBLE_SHIFTS) & np.uint64(15)
+    nibbles[:, 16:] = (lo[:, None] >> NIBBLE_SHIFTS) & np.uint64(15)
+
+    chars = np.full((hi.shape[0], 36), ord("-"), dtype=np.uint8)
+    chars[:, UUID_HEX_POSITIONS] = HEX_DIGITS[nibbles]
+
+    return chars.view("S36").ravel().astype(str).astype(object)
+
+
+def format_amount(minor: pd.Series) -> np.ndarray:
+    """
+    Formats amounts in minor units as text with two decimals ("-208.90"), None for missing ones.
+    """
+
+    text = np.full(minor.shape[0], None, dtype=object)
+    present = minor.notna().to_numpy()
+    text[present] = np.char.mod("%.2f", minor[present].to_numpy(dtype="float64") / AMOUNT_SCALE)
+
+    return text
+
+
+def compact_column(col: str, values: pd.Series) -> Optional[dict]:
+    """
+    Returns the compact column(s) representing one raw column, or None if it is not compacted.
+    """
+
+    if col in UUID_COLUMNS:
+        pair = uuid_to_pair(values)
+        if pair is not None:
+            return {f"{col}_hi": pair[0], f"{col}_lo": pair[1]}
+
+    elif col == "amount":
+        amount = pd.to_numeric(values, errors="coerce")
+        minor = np.rint(amount * AMOUNT_SCALE).astype("Int64")
+        # Only compact if every amount is written with exactly two decimals, so format_amount gives back its raw text.
+        if amount.isna().sum() == values.isna().sum() and (format_amount(minor) == values.to_numpy(dtype=object))[values.notna()].all():
+            return {"amountMinor": minor}
+
+    elif col == "sourceDate":
+        source_date = parse_dates(values, SOURCE_DATE_FORMAT)
+        # Only compact if every date is in SOURCE_DATE_FORMAT itself, so strftime gives back its raw text.
+        if source_date.isna().sum() == values.isna().sum() and (source_date.dt.strftime(SOURCE_DATE_FORMAT) == values)[values.notna()].all():
+            return {col: source_date}
+
+    elif col in CATEGORICAL_COLUMNS:
+        return {col: values.astype("category")}
+
+    elif col in INTEGER_COLUMNS and pd.api.types.is_integer_dtype(values):
+        return {col: pd.to_numeric(values, downcast="integer")}
+
+    return None
+
+
+def to_compact_schema(df: pd.DataFrame, layout: Optional[FrozenSet[str]] = None) -> Tuple[Optional[pd.DataFrame], FrozenSet[str]]:
+    """
+    Converts a raw transactions DataFrame (after initial_df_quality_checks) to the compact representation.
+
+    Parameters:
+    - df (pd.DataFrame): The raw transactions.
+    - layout (FrozenSet[str]): The raw columns to compact, as returned for the file's first chunk. None compacts
+      every column that can be represented exactly (for the first chunk).
+
+    Returns:
+    - pd.DataFrame: The compact DataFrame, or None if a column of layout cannot be represented exactly in df
+      (the file is then processed in the regular representation). Convert back with from_compact_schema.
+    - FrozenSet[str]: The raw columns held in compact form.
+    """
+
+    compact = {}
+    compacted = set()
+
+    for col in df.columns:
+
+        converted = compact_column(col, df[col]) if layout is None or col in layout else None
+
+        if converted is None:
+            if layout is not None and col in layout:
+                return None, layout
+            compact[col] = df[col]
+            continue
+
+        compact.update(converted)
+        compacted.add(col)
+
+    return pd.DataFrame(compact, index=df.index), frozenset(compacted)
+
+
+def from_compact_schema(df: pd.DataFrame, raw_text: Tuple[str, ...] = ()) -> pd.DataFrame:
+    """
+    Converts a compact DataFrame back to the regular representation (string UUIDs, float amounts,
+    plain object columns), e.g. before writing it out or loading it.
+
+    Parameters:
+    - df (pd.DataFrame): A DataFrame returned by to_compact_schema, or a slice of it.
+    - raw_text (Tuple[str, ...]): Of 'amount' and 'sourceDate', the columns to give back as their raw text
+      rather than parsed, e.g. for removed rows. to_compact_schema only compacts values it can give back exactly.
+
+    Returns:
+    - pd.DataFrame: The DataFrame with the original column names and order.
+    """
+
+    regular = {}
+
+    for col in df.columns:
+
+        values = df[col]
+
+        if col.endswith("_hi") and col[:-3] in UUID_COLUMNS:
+            name = col[:-3]
+            regular[name] = pair_to_uuid(values.to_numpy(), df[f"{name}_lo"].to_numpy())
+        elif col.endswith("_lo") and col[:-3] in UUID_COLUMNS:
+            continue
+        elif col == "amountMinor" and "amount" in raw_text:
+            regular["amount"] = format_amount(values)
+        elif col == "amountMinor":
+            regular["amount"] = values.astype("float64") / AMOUNT_SCALE
+        elif col in raw_text and pd.api.types.is_datetime64_any_dtype(values.dtype):
+            regular[col] = values.dt.strftime(SOURCE_DATE_FORMAT).astype(object).where(values.notna(), None)
+        elif isinstance(values.dtype, pd.CategoricalDtype):
+            regular[col] = values.astype(object)
+        else:
+            regular[col] = values
+
+    return pd.DataFrame(regular, index=df.index)
+
+
+def concat_frames(frames: List[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Concatenates DataFrames like pd.concat(..., ignore_index=True), but keeps categorical columns categorical
+    when the frames have different categories (pd.concat would fall back to object).
+    If compact and regular frames are mixed (a file switched to the regular representation part way),
+    every frame is converted back with from_compact_schema first.
+    """
+
+    if not frames:
+        return pd.DataFrame()
+
+    if any(list(frame.columns) != list(frames[0].columns) for frame in frames):
+        # Amounts and sourceDates that are still raw text in the regular frames are given back as their raw text.
+        raw_text = tuple(col for col in ("amount", "sourceDate") if any(col in frame.columns and frame[col].dtype == object for frame in frames))
+        frames = [from_compact_schema(frame, raw_text) for frame in frames]
+
+        # Any other converted column next to a raw text one is kept as text too, so it can still be written to Arrow.
+        for col in frames[0].columns:
+            if any(frame[col].dtype == object for frame in frames) and len({frame[col].dtype for frame in frames}) > 1:
+                frames = [frame.assign(**{col: frame[col].astype(str).where(frame[col].notna(), None)}) for frame in frames]
+
+    columns = {}
+
+    for col in frames[0].columns:
+
+        if all(isinstance(frame[col].dtype, pd.CategoricalDtype) for frame in frames):
+            columns[col] = pd.Series(union_categoricals([frame[col] for frame in frames]))
+        else:
+            columns[col] = pd.concat([frame[col] for frame in frames], ignore_index=True)
+
+    return pd.DataFrame(columns)
+
+
+def transaction_key(df: pd.DataFrame) -> np.ndarray:
+    """
+    Returns one hashable value per row identifying its transaction: the transactionId string, or,
+    for compact frames, an int64 code combining the two uint64 halves.
+    """
+
+    if "transactionId" in df.columns:
+        return df["transactionId"].to_numpy()
+
+    hi_codes, hi_uniques = pd.factorize(df["transactionId_hi"])
+    lo_codes, lo_uniques = pd.factorize(df["transactionId_lo"])
+
+    return hi_codes.astype(np.int64) * len(lo_uniques) + lo_codes
+
+
+def transaction_hash(df: pd.DataFrame) -> np.ndarray:
+    """
+    Returns a uint64 hash of each row's transaction, stable across frames (unlike transaction_key),
+    so rows of the same transaction can be routed to the same partition. Compact frames hash their
+    transactionIds converted back to strings, so a transaction lands in the same partition whether its
+    chunk was compact or not.
+    """
+
+    if "transactionId" in df.columns:
+        transaction_ids = df["transactionId"].to_numpy(dtype=object)
+    else:
+        transaction_ids = pair_to_uuid(df["transactionId_hi"].to_numpy(), df["transactionId_lo"].to_numpy())
+
+    return pd.util.hash_pandas_object(pd.Series(transaction_ids, dtype=object), index=False).to_numpy()
+
+
+def memory_report(df: pd.DataFrame, df_compact: pd.DataFrame) -> str:
+    """
+    Describes the memory used per million rows by the regular and compact representations of the same rows.
+    """
+
+    rows = max(df.shape[0], 1)
+    regular_mb = df.memory_usage(deep=True).sum() / rows * 1e6 / 2**20
+    compact_mb = df_compact.memory_usage(deep=True).sum() / rows * 1e6 / 2**20
+
+    return (f"Compact schema: {compact_mb:,.1f} MB per million rows "
+            f"(regular: {regular_mb:,.1f} MB, x{regular_mb / max(compact_mb, 1e-9):.1f} smaller).")
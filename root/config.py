@@ -1,7 +1,65 @@
+import os
+
 raw_data_path = r"data/raw_data/"
 removed_data_path = r"data/removed_data"
 final_data_path = r"data/final_data"
 log_path = r"data/logs/" # config
+log_level = os.environ.get("SNOOP_LOG_LEVEL", "INFO") # config - DEBUG also logs SQL text and DataFrames
+log_buffer_size = 1000 # config - log records buffered before they are written
+metrics_trace_memory = False # config - measure each stage's peak Python allocations with tracemalloc (slower)
+metrics_profile_stage = os.environ.get("SNOOP_PROFILE_STAGE") # config - name of one stage to run under cProfile, e.g. "validation_rules"
 date_fmt = '%Y-%m-%d' # config
 allowed_currency = ["GBP", "USD", "EUR"] # config
-REQUIRED_COLUMNS = "customerId","customerName","transactionId","transactionDate","sourceDate","merchantId","categoryId","currency","amount","description"
\ No newline at end of file
+amount_range = None # config - (min, max) allowed amount, e.g. (-100000, 100000); None disables the check
+allowed_merchant_ids = None # config - whitelist of merchantIds; None disables the check
+REQUIRED_COLUMNS = "customerId","customerName","transactionId","transactionDate","sourceDate","merchantId","categoryId","currency","amount","description"
+
+chunk_size = 100000 # config - rows per chunk when streaming the raw JSON file
+raw_read_workers = 4 # config - part files of a day read and decompressed concurrently
+raw_read_prefetch_chunks = 2 # config - chunks each part reader may parse ahead of validation
+raw_index_path = r"data/raw_index.json" # config - raw files grouped by day, refreshed when raw_data_path changes (see helper_utils.raw_file_index)
+compact_schema = True # config - validate and deduplicate on a compact representation (see compact_schema.py)
+
+use_copy_loader = True # config - False falls back to the string-built INSERT loader, kept for comparison
+copy_batch_rows = 50000 # config - rows serialised per batch when streaming a DataFrame through COPY
+maintain_daily_rollup = True # config - keep customer_daily_totals (per customer, day and currency sums and counts) up to date in the load transaction
+
+# Database connection, overridable through the environment.
+db_config = {
+    "dbname": os.environ.get("SNOOP_DB_NAME", "SNOOP_DATABASE"),
+    "user": os.environ.get("SNOOP_DB_USER", "postgres"),
+    "password": os.environ.get("SNOOP_DB_PASSWORD", "password143"),
+    "host": os.environ.get("SNOOP_DB_HOST", "localhost"),
+    "port": os.environ.get("SNOOP_DB_PORT", "5432"),
+}
+db_pool_min_connections = 1 # config
+parallel_load_workers = int(os.environ.get("SNOOP_LOAD_WORKERS", 1)) # config - connections loading transaction shards in parallel, e.g. the database host's core count; 1 disables sharding
+db_pool_max_connections = int(os.environ.get("SNOOP_DB_POOL_MAX", max(4, parallel_load_workers + 1))) # config - at least parallel_load_workers + 1 (the shards plus the merging transaction)
+
+processed_manifest_path = r"data/processed_files.json" # config - raw files already loaded into the database
+catch_up_workers = os.cpu_count() # config - processes used to validate files in catch-up mode
+watch_poll_seconds = float(os.environ.get("SNOOP_WATCH_POLL_SECONDS", 10)) # config - watch mode: how often raw_data_path is scanned for new files
+watch_queue_size = 2 # config - watch mode: files waiting to be processed before the watcher stops scanning (backpressure)
+
+intermediate_format = "feather" # config - format of final_data/removed_data files: "feather" (typed, memory-mappable Arrow) or "csv"
+write_final_data = True # config - write the validated/customers/transactions files; loading always uses the in-memory frames
+write_csv_copy = True # config - also write CSV copies of the feather files for human inspection
+
+benchmark_path = r"data/benchmarks/" # config - synthetic raw files, outputs and results of benchmark.py
+benchmark_regression_threshold = 0.2 # config - flag a stage as a regression when it is this much slower than the previous run
+
+use_known_ids = True # config - skip rows whose ID a previous load committed, using the local index in known_ids_path (see known_ids.py)
+known_ids_path = r"data/known_ids/" # config
+use_transaction_state = True # config - classify transactions as new, amended or unchanged against the state in transaction_state_path, updating amended ones (see transaction_state.py)
+transaction_state_path = r"data/transaction_state/" # config
+
+# out_of_core bounds the memory of validation and duplicate resolution only: the kept rows of every partition are
+# then joined into one frame, converted back to the regular schema and loaded whole, so a file's valid rows must
+# still fit in memory (roughly 600 MB per million rows), which rules out files larger than RAM.
+out_of_core = os.environ.get("SNOOP_OUT_OF_CORE", "0") == "1" # config - spill valid rows to disk partitioned by transactionId and resolve cross-chunk duplicates one partition at a time
+memory_budget_mb = int(os.environ.get("SNOOP_MEMORY_BUDGET_MB", 1024)) # config - out_of_core: memory one partition may take while it is deduplicated; sets the number of partitions
+spill_path = r"data/spill/" # config - out_of_core: where partitions are spilled (removed after each file)
+
+validation_workers = int(os.environ.get("SNOOP_VALIDATION_WORKERS", 1)) # config - processes validating hash partitions of a file in parallel; 1 validates chunk by chunk in this process
+
+run_manifest_path = r"data/run_manifest.json" # config - completed stages and artifacts per raw file content hash (see run_manifest.py)
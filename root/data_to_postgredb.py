@@ -1,17 +1,481 @@
 import psycopg2
+import numpy as np
 import pandas as pd
+import io, time, uuid
+from typing import Callable, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from db_connection import get_connection_pool
+from helper_utils import (read_frame, get_run_logger)
+from known_ids import drop_known_rows
+from transaction_state import (classify_transactions, PREVIOUS_DATE_COLUMN)
+from date_parsing import parse_dates
+from config import (use_copy_loader, copy_batch_rows, final_data_path, parallel_load_workers, db_pool_max_connections,
+                    maintain_daily_rollup, date_fmt)
+
+
+class DataFrameCSVStream(io.TextIOBase):
+    """
+    Read-only file-like view of a DataFrame as headerless CSV, for use with COPY ... FROM STDIN.
+    Rows are serialised copy_batch_rows at a time as COPY asks for more data, so the whole
+    table is never held in memory as one string.
+    """
+
+    def __init__(self, df: pd.DataFrame, batch_rows: int = copy_batch_rows) -> None:
+
+        self.df = df
+        self.batch_rows = batch_rows
+        self.position = 0
+        self.buffer = ""
+        # Characters of buffer already read; the buffer is only rebuilt when a batch is added.
+        self.offset = 0
+
+    def readable(self):
+
+        return True
+
+    def read(self, size=-1):
+
+        while (size is None or size < 0 or len(self.buffer) - self.offset < size) and self.position < self.df.shape[0]:
+            batch = self.df.iloc[self.position : self.position + self.batch_rows]
+            self.buffer = self.buffer[self.offset:] + batch.to_csv(header=False, index=False)
+            self.offset = 0
+            self.position += self.batch_rows
+
+        if size is None or size < 0:
+            data = self.buffer[self.offset:]
+        else:
+            data = self.buffer[self.offset : self.offset + size]
+        self.offset += len(data)
+
+        return data
+
+
+ROLLUP_TABLE = "customer_daily_totals"
+AMENDED_STAGING_TABLE = "TRANSACTIONS_amended"
+
+# Per customer, day and currency totals of the loaded transactions, for dashboards to read instead of
+# aggregating TRANSACTIONS.
+create_rollup_table_query = f"""CREATE TABLE {ROLLUP_TABLE}
+    (
+CUSTOMER_ID VARCHAR (100) NOT NULL,
+TRANSACTION_DATE date NOT NULL,
+CURRENCY varchar(20) NOT NULL,
+TRANSACTION_COUNT bigint NOT NULL,
+AMOUNT_TOTAL NUMERIC(22, 4) NOT NULL,
+UPDATED_ON timestamp,
+PRIMARY KEY (CUSTOMER_ID, TRANSACTION_DATE, CURRENCY)
+    );"""
+
+rollup_conflict_clause = """ON CONFLICT (CUSTOMER_ID, TRANSACTION_DATE, CURRENCY) DO UPDATE
+            SET TRANSACTION_COUNT = r.TRANSACTION_COUNT + EXCLUDED.TRANSACTION_COUNT,
+                AMOUNT_TOTAL = r.AMOUNT_TOTAL + EXCLUDED.AMOUNT_TOTAL,
+                UPDATED_ON = EXCLUDED.UPDATED_ON"""
+
+
+def with_daily_rollup(insert_query: str) -> str:
+    """
+    Wraps an INSERT INTO TRANSACTIONS statement so that the rows it actually inserts are added to the rollup
+    table by the same statement. Rows skipped because their transaction was already loaded add nothing, so
+    re-sent and replaced duplicates never count twice. The wrapped statement returns the number of rows inserted.
+    """
+
+    return f"""WITH inserted AS ({insert_query}
+            RETURNING CUSTOMER_ID, TRANSACTION_DATE, CURRENCY, AMOUNT),
+        rolled_up AS (INSERT INTO {ROLLUP_TABLE} AS r (CUSTOMER_ID, TRANSACTION_DATE, CURRENCY, TRANSACTION_COUNT, AMOUNT_TOTAL, UPDATED_ON)
+            SELECT CUSTOMER_ID, TRANSACTION_DATE, CURRENCY, COUNT(*), COALESCE(SUM(AMOUNT), 0), now() FROM inserted
+            GROUP BY CUSTOMER_ID, TRANSACTION_DATE, CURRENCY
+            {rollup_conflict_clause})
+        SELECT COUNT(*) FROM inserted"""
+
+
+def with_amended_daily_rollup(update_query: str) -> str:
+    """
+    Wraps the UPDATE of amended transactions (see update_amended_transactions) so that the same statement
+    moves each updated row's contribution in the rollup table from its previous values to its new ones:
+    the previous row is subtracted from its customer, day and currency, and the new row added to its own.
+    The wrapped statement returns the number of rows updated.
+    """
+
+    # Every part of a statement sees the table as it was before the statement, so previous holds the old rows.
+    return f"""WITH previous AS (SELECT t.TRANSACTION_ID, t.CUSTOMER_ID, t.TRANSACTION_DATE, t.CURRENCY, t.AMOUNT
+            FROM TRANSACTIONS t JOIN {AMENDED_STAGING_TABLE} s
+            ON t.TRANSACTION_ID = s.TRANSACTION_ID AND t.TRANSACTION_DATE = s.PREVIOUS_TRANSACTION_DATE),
+        updated AS ({update_query}
+            RETURNING t.TRANSACTION_ID, t.CUSTOMER_ID, t.TRANSACTION_DATE, t.CURRENCY, t.AMOUNT),
+        deltas AS (SELECT CUSTOMER_ID, TRANSACTION_DATE, CURRENCY, 1 AS TRANSACTION_COUNT, AMOUNT FROM updated
+            UNION ALL
+            SELECT p.CUSTOMER_ID, p.TRANSACTION_DATE, p.CURRENCY, -1, -p.AMOUNT FROM previous p
+            JOIN updated u ON u.TRANSACTION_ID = p.TRANSACTION_ID),
+        rolled_up AS (INSERT INTO {ROLLUP_TABLE} AS r (CUSTOMER_ID, TRANSACTION_DATE, CURRENCY, TRANSACTION_COUNT, AMOUNT_TOTAL, UPDATED_ON)
+            SELECT CUSTOMER_ID, TRANSACTION_DATE, CURRENCY, SUM(TRANSACTION_COUNT), COALESCE(SUM(AMOUNT), 0), now() FROM deltas
+            GROUP BY CUSTOMER_ID, TRANSACTION_DATE, CURRENCY
+            {rollup_conflict_clause})
+        SELECT COUNT(*) FROM updated"""
+
+
+def rollup_table_query(conn) -> str:
+    """
+    Returns the statements creating the rollup table, backfilled from the transactions already loaded
+    (the only time TRANSACTIONS is aggregated as a whole), or an empty string if it exists.
+    They are run with the TRANSACTIONS schema statements, after them (see transactions_schema_query).
+    """
 
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass(%s)", (ROLLUP_TABLE,))
+        if cur.fetchone()[0] is not None:
+            return ""
+
+    get_run_logger().info(f"Creating {ROLLUP_TABLE}, backfilled from TRANSACTIONS.", table=ROLLUP_TABLE)
+
+    return create_rollup_table_query + f"""
+INSERT INTO {ROLLUP_TABLE} (CUSTOMER_ID, TRANSACTION_DATE, CURRENCY, TRANSACTION_COUNT, AMOUNT_TOTAL, UPDATED_ON)
+    SELECT CUSTOMER_ID, TRANSACTION_DATE, CURRENCY, COUNT(*), COALESCE(SUM(AMOUNT), 0), now() FROM TRANSACTIONS
+    GROUP BY CUSTOMER_ID, TRANSACTION_DATE, CURRENCY;"""
+
+
+TRANSACTION_IDS_TABLE = "transaction_ids"
+
+# Every transactionId ever inserted into TRANSACTIONS. The partitioned table's primary key has to include
+# TRANSACTION_DATE, so this unpartitioned table is what keeps a transactionId from being stored twice (e.g.
+# re-sent with another date): a load claims its IDs here first and only inserts the rows it could claim.
+create_transaction_ids_table_query = f"""CREATE TABLE {TRANSACTION_IDS_TABLE}
+    (
+TRANSACTION_ID VARCHAR (100) NOT NULL PRIMARY KEY
+    );"""
+
+
+def transaction_ids_table_query(conn) -> str:
+    """
+    Returns the statements creating the transaction_ids table, backfilled from the transactions already
+    loaded, or an empty string if it exists. They are run with the TRANSACTIONS schema statements, after them.
+    """
+
+    with conn.cursor() as cur:
+        cur.execute("SELECT to_regclass(%s)", (TRANSACTION_IDS_TABLE,))
+        if cur.fetchone()[0] is not None:
+            return ""
+
+    get_run_logger().info(f"Creating {TRANSACTION_IDS_TABLE}, backfilled from TRANSACTIONS.", table=TRANSACTION_IDS_TABLE)
+
+    return create_transaction_ids_table_query + f"""
+INSERT INTO {TRANSACTION_IDS_TABLE} (TRANSACTION_ID)
+    SELECT DISTINCT TRANSACTION_ID FROM TRANSACTIONS;"""
+
+
+def claim_transaction_ids(staging_table: str) -> str:
+    """
+    Returns the statement claiming the transactionIds of a staging table in transaction_ids and deleting the
+    staging rows whose transactionId was claimed before, by an earlier load or a concurrent one (which the
+    primary key makes wait until it commits). Run in the load's transaction before the merge, so the claims
+    commit or roll back with the rows.
+    """
+
+    return f"""WITH claimed AS (INSERT INTO {TRANSACTION_IDS_TABLE} (TRANSACTION_ID)
+            SELECT DISTINCT TRANSACTION_ID FROM {staging_table}
+            ON CONFLICT (TRANSACTION_ID) DO NOTHING
+            RETURNING TRANSACTION_ID)
+        DELETE FROM {staging_table} s WHERE NOT EXISTS (SELECT 1 FROM claimed c WHERE c.TRANSACTION_ID = s.TRANSACTION_ID)"""
+
+
+def execute_merge(cur, merge_query: str, wrap_merge: Optional[Callable[[str], str]] = None) -> int:
+    """
+    Runs a merge statement, wrapped by wrap_merge if given (see with_daily_rollup), and returns the number of rows inserted.
+    """
+
+    if wrap_merge is None:
+        cur.execute(merge_query)
+        return cur.rowcount
+
+    cur.execute(wrap_merge(merge_query))
+    return cur.fetchone()[0]
+
+
+def build_merge_query(table: str, staging_table: str, cols: str, primary_key: str, target_filter: str = None) -> str:
+    """
+    Returns the statement inserting the staging table's rows whose primary key is not in the target table yet.
+    ON CONFLICT only guards against rows inserted concurrently by another run.
+
+    Parameters:
+    - primary_key (str): Comma separated primary key columns of the target table.
+    - target_filter (str): Optional condition on the target table's rows (alias t) that can match, so the
+      anti-join only reads the partitions of a partitioned table the batch falls into.
+    """
+
+    match = " AND ".join(f"t.{column} = s.{column}" for column in (column.strip() for column in primary_key.split(",")))
+    if target_filter:
+        match += f" AND {target_filter}"
+
+    return f"""INSERT INTO {table} ({cols})
+        SELECT {cols} FROM {staging_table} s
+        WHERE NOT EXISTS (SELECT 1 FROM {table} t WHERE {match})
+        ON CONFLICT ({primary_key}) DO NOTHING"""
+
+
+def copy_SQLtable_update(conn, df: pd.DataFrame, table: str, cols: str, primary_key: str,
+                         wrap_merge: Optional[Callable[[str], str]] = None, target_filter: str = None,
+                         claim_keys: Optional[Callable[[str], str]] = None):
+    """
+    Loads a DataFrame into a table by streaming it through COPY into a temporary staging table,
+    then merging the staging table into the target table. Rows whose primary key already exists are skipped.
+    Nothing is committed here: the caller owns the transaction (see db_connection.db_transaction).
+    Returns the number of rows inserted.
+    The "already loaded?" check is an anti-join of the staging table against the target's primary key,
+    so its cost depends on the size of the batch and not on the size of the table.
+
+    Parameters:
+    - conn: An open psycopg2 connection.
+    - df (pd.DataFrame): The rows to load, with columns in the same order as cols.
+    - table (str): The target table.
+    - cols (str): Comma separated target column names.
+    - primary_key (str): Comma separated primary key columns of the target table.
+    - wrap_merge (Callable): Optionally wraps the merge statement, e.g. with_daily_rollup.
+    - target_filter (str): Optionally restricts the target rows the anti-join reads (see build_merge_query).
+    - claim_keys (Callable): Optionally builds a statement run on the staging table before the merge,
+      e.g. claim_transaction_ids.
+    """
+
+    staging_table = f"{table}_staging"
+
+    create_staging_query = f"CREATE TEMP TABLE {staging_table} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP"
+    copy_query = f"COPY {staging_table} ({cols}) FROM STDIN WITH (FORMAT csv)"
+    # Temp tables are not analysed automatically; without statistics the planner may pick a poor anti-join.
+    analyze_query = f"ANALYZE {staging_table}"
+
+    merge_query = build_merge_query(table, staging_table, cols, primary_key, target_filter)
+
+    logger = get_run_logger()
+    start = time.perf_counter()
+
+    with conn.cursor() as cur:
+
+        try:
+            cur.execute(create_staging_query)
+            cur.copy_expert(copy_query, DataFrameCSVStream(df))
+            if claim_keys is not None:
+                cur.execute(claim_keys(staging_table))
+            cur.execute(analyze_query)
+            rows_inserted = execute_merge(cur, merge_query, wrap_merge)
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            logger.error("Error: %s" % error)
+            raise
+
+    elapsed = time.perf_counter() - start
+    rows_staged = df.shape[0]
+
+    logger.info(f"{table}: copied {rows_staged} rows, inserted {rows_inserted} new rows, "
+                f"skipped {rows_staged - rows_inserted} already loaded "
+                f"in {elapsed:.2f}s ({rows_staged / max(elapsed, 1e-9):.0f} rows/s).",
+                table=table, rows_copied=rows_staged, rows_inserted=rows_inserted, seconds=round(elapsed, 3))
+
+    return rows_inserted
+
+
+def shard_frame(df: pd.DataFrame, key: str, shards: int) -> List[pd.DataFrame]:
+    """
+    Splits a DataFrame into shards by a hash of its key column, so every row of a given key lands in the same shard.
+    """
+
+    shard_of_row = pd.util.hash_pandas_object(df[key], index=False).to_numpy() % shards
+
+    return [df[shard_of_row == shard] for shard in range(shards)]
+
+
+def copy_shard(staging_table: str, cols: str, df: pd.DataFrame) -> int:
+    """
+    Streams one shard into the shared staging table over its own pooled connection, and commits it.
+    Returns the number of rows copied.
+    """
+
+    conn_pool = get_connection_pool()
+    conn = conn_pool.getconn()
+
+    try:
+        with conn.cursor() as cur:
+            cur.copy_expert(f"COPY {staging_table} ({cols}) FROM STDIN WITH (FORMAT csv)", DataFrameCSVStream(df))
+        conn.commit()
+
+    except (Exception, psycopg2.DatabaseError):
+        conn.rollback()
+        raise
+
+    finally:
+        conn_pool.putconn(conn)
+
+    return df.shape[0]
+
+
+def drop_staging_tables(conn, staging_tables: List[str]):
+    """
+    Drops shared staging tables and commits.
+    """
+
+    with conn.cursor() as cur:
+        for staging_table in staging_tables:
+            cur.execute(f"DROP TABLE IF EXISTS {staging_table}")
+    conn.commit()
+
+
+def drop_leftover_staging_tables(conn, table: str):
+    """
+    Drops the shared staging tables of table left behind by parallel loads whose transaction was rolled
+    back after the merge (the DROP is rolled back with it). Only call this when no load is running.
+    Returns the number of tables dropped.
+    """
+
+    with conn.cursor() as cur:
+        cur.execute("SELECT tablename FROM pg_tables WHERE tablename LIKE %s",
+                    (table.lower().replace("_", "\\_") + "\\_staging\\_%",))
+        staging_tables = [row[0] for row in cur.fetchall()]
+
+    drop_staging_tables(conn, staging_tables)
+
+    return len(staging_tables)
+
+
+def parallel_copy_SQLtable_update(conn, df: pd.DataFrame, table: str, cols: str, primary_key: str, key: str,
+                                  create_table_query: str, workers: int = parallel_load_workers,
+                                  wrap_merge: Optional[Callable[[str], str]] = None, target_filter: str = None,
+                                  claim_keys: Optional[Callable[[str], str]] = None):
+    """
+    Loads a DataFrame like copy_SQLtable_update, but COPYs it in parallel: the rows are split into
+    workers shards by a hash of key, and each shard is streamed over its own pooled connection from a
+    thread pool into a shared UNLOGGED staging table. The staging table is then merged into the target
+    table by a single statement on conn, so the load still commits or rolls back with the caller's transaction.
+    As temporary tables are only visible to their own session, the staging table is a regular table,
+    created up front and dropped in conn's transaction after the merge. If the load fails, conn's transaction
+    is rolled back and the staging table dropped straight away; if the caller rolls back later, the table is
+    left behind (see drop_leftover_staging_tables).
+    Returns the number of rows inserted.
+
+    Parameters:
+    - conn: An open psycopg2 connection; the merge runs in its transaction.
+    - df (pd.DataFrame): The rows to load, with columns in the same order as cols.
+    - table (str): The target table.
+    - cols (str): Comma separated target column names.
+    - primary_key (str): Comma separated primary key columns of the target table.
+    - key (str): The DataFrame column the rows are sharded by.
+    - create_table_query (str): The CREATE TABLE IF NOT EXISTS statement(s) of the target table. They must not
+      have been run in conn's open transaction, or the setup connection would wait on it.
+    - workers (int): The number of shards and connections.
+    - wrap_merge (Callable): Optionally wraps the merge statement, e.g. with_daily_rollup.
+    - target_filter (str): Optionally restricts the target rows the anti-join reads (see build_merge_query).
+    - claim_keys (Callable): Optionally builds a statement run on the staging table before the merge, in conn's
+      transaction, e.g. claim_transaction_ids.
+    """
+
+    logger = get_run_logger()
+
+    # The merging transaction holds one pooled connection; the shards can use the rest.
+    if workers >= db_pool_max_connections:
+        logger.warning(f"{workers} load workers need {workers + 1} connections but the pool holds {db_pool_max_connections}; "
+                       f"using {db_pool_max_connections - 1}.")
+        workers = max(1, db_pool_max_connections - 1)
+
+    staging_table = f"{table}_staging_{uuid.uuid4().hex[:12]}"
+
+    # Not logged to the WAL: the rows only live until the merge.
+    create_staging_query = f"CREATE UNLOGGED TABLE {staging_table} (LIKE {table} INCLUDING DEFAULTS)"
+    analyze_query = f"ANALYZE {staging_table}"
+    merge_query = build_merge_query(table, staging_table, cols, primary_key, target_filter)
+    drop_staging_query = f"DROP TABLE {staging_table}"
+
+    start = time.perf_counter()
+
+    # The staging table has to be committed before the shard connections can see it, and it is defined
+    # LIKE the target table, so the target table is created (if need be) and committed alongside it.
+    conn_pool = get_connection_pool()
+    setup_conn = conn_pool.getconn()
+
+    try:
+        with setup_conn.cursor() as cur:
+            cur.execute(create_table_query)
+            cur.execute(create_staging_query)
+        setup_conn.commit()
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        setup_conn.rollback()
+        logger.error("Error: %s" % error)
+        raise
+
+    finally:
+        conn_pool.putconn(setup_conn)
+
+    try:
+        shards = shard_frame(df, key, workers)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            rows_staged = sum(executor.map(lambda shard: copy_shard(staging_table, cols, shard), shards))
+
+        copy_elapsed = time.perf_counter() - start
+
+        with conn.cursor() as cur:
+            if claim_keys is not None:
+                cur.execute(claim_keys(staging_table))
+            cur.execute(analyze_query)
+            rows_inserted = execute_merge(cur, merge_query, wrap_merge)
+            cur.execute(drop_staging_query)
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        logger.error("Error: %s" % error)
+        # conn's transaction may hold locks on the staging table; release them before dropping it.
+        conn.rollback()
+        cleanup_conn = conn_pool.getconn()
+        try:
+            drop_staging_tables(cleanup_conn, [staging_table])
+        finally:
+            conn_pool.putconn(cleanup_conn)
+        raise
+
+    elapsed = time.perf_counter() - start
+
+    logger.info(f"{table}: copied {rows_staged} rows in {workers} shards in {copy_elapsed:.2f}s, inserted {rows_inserted} new rows, "
+                f"skipped {rows_staged - rows_inserted} already loaded "
+                f"in {elapsed:.2f}s ({rows_staged / max(elapsed, 1e-9):.0f} rows/s).",
+                table=table, rows_copied=rows_staged, rows_inserted=rows_inserted, shards=workers,
+                copy_seconds=round(copy_elapsed, 3), seconds=round(elapsed, 3))
+
+    return rows_inserted
+
+
+def distinct_rows(df: pd.DataFrame) -> List[tuple]:
+    """
+    Returns the distinct rows of a DataFrame as tuples of Python values, missing values (NaN, NaT) as None.
+    """
+
+    return list(set(tuple(x) for x in df.astype(object).where(df.notna(), None).to_numpy()))
+
+
+def values_list(cur, tuples: List[tuple]) -> str:
+    """
+    Returns rows as the VALUES list of an INSERT statement, each value quoted by psycopg2 (cur.mogrify), so
+    typed columns such as Timestamps become SQL literals and None becomes NULL.
+    Used by the string-built INSERT loader (use_copy_loader = False).
+    """
+
+    if not tuples:
+        return ""
+
+    placeholders = "(" + ",".join(["%s"] * len(tuples[0])) + ")"
+
+    return ",".join(cur.mogrify(placeholders, x).decode() for x in tuples)
 
 
-def customer_SQLtable_update(latest_file_date):
+def customer_SQLtable_update(latest_file_date, conn, df_customers = None):
 
-    df_customers = pd.read_csv(fr"data\final_data\customers_only_transactions_{latest_file_date}.csv")
+    logger = get_run_logger()
+    logger.set_stage("load_customers")
+
+    # Read the day's customers from final_data unless they were handed over in memory.
+    if df_customers is None:
+        df_customers = read_frame(final_data_path, f"customers_only_transactions_{latest_file_date}",
+                                  columns = ["customerId", "customerName", "createdOn"])
 
     cols = "CUSTOMER_ID,CUSTOMER_NAME,CREATED_ON"
 
     table ="customers"
 
-    create_table_query = """CREATE TABLE IF NOT EXISTS customersTest
+    create_table_query = """CREATE TABLE IF NOT EXISTS customers
         (
     CUSTOMER_ID VARCHAR (100) NOT NULL PRIMARY KEY, 
     CUSTOMER_NAME VARCHAR (100) NOT NULL,
@@ -19,137 +483,317 @@ def customer_SQLtable_update(latest_file_date):
 
         );"""
 
-    select_customers_query = "SELECT * FROM CUSTOMERS"
-
-    conn = psycopg2.connect("dbname='{db}' user='{user}' host='{host}' port='{port}' password='{passwd}'".format(
-                user="postgres",
-                passwd="password143",
-                host="localhost",
-                port="5432",
-                db="SNOOP_DATABASE"))
-
+    # Only the IDs of the incoming batch are looked up, via the primary key index.
+    select_customers_query = "SELECT CUSTOMER_ID FROM customers WHERE CUSTOMER_ID = ANY(%s)"
 
     with conn.cursor() as cur:
 
         cur.execute(create_table_query)
-        conn.commit()
+
+    df_customers = drop_known_rows(df_customers, "customers")
+
+    if df_customers.shape[0] == 0:
+
+        logger.info("Customer table already up to date.")
+        return 0
+
+    if use_copy_loader:
+
+        return copy_SQLtable_update(conn, df_customers, table, cols, primary_key = "CUSTOMER_ID")
+
+    with conn.cursor() as cur:
 
         all_customer_ids = []
 
         try:
-            cur.execute(select_customers_query)
+            cur.execute(select_customers_query, (df_customers["customerId"].unique().tolist(),))
             all_records = cur.fetchall()    
             for row in all_records:
                 all_customer_ids.append(row[0])
             
         except (Exception, psycopg2.DatabaseError) as error:
-            print("Error: %s" % error)
-            conn.rollback()
+            logger.error("Error: %s" % error)
+            raise
 
         if len(all_customer_ids) > 0:
 
             df_customers = df_customers[~ df_customers["customerId"].isin(all_customer_ids)]
-            print(df_customers)
+            if logger.enabled("DEBUG"):
+                logger.debug("New customers.", frame=df_customers.to_string())
 
         if df_customers.shape[0] == 0:
 
-            print("Customer table already up to date.")
-            return
-
-        tuples = list(set([tuple(x) for x in df_customers.to_numpy()]))
-        
-        tuples_as_string = ""
-        print(tuples_as_string)
-
-        for x in tuples:
-            tuples_as_string += str(x) + ","
+            logger.info("Customer table already up to date.")
+            return 0
 
-        tuples_as_string = tuples_as_string[:-1]
+        tuples = distinct_rows(df_customers)
+        tuples_as_string = values_list(cur, tuples)
 
         insert_records_query = f"INSERT INTO {table}({cols}) VALUES {tuples_as_string}" 
-        print(insert_records_query)
+        logger.debug("Insert query.", query=insert_records_query)
         try:
             cur.execute(insert_records_query)
-            conn.commit()
 
         except (Exception, psycopg2.DatabaseError) as error:
-            print("Error: %s" % error)
-            conn.rollback()
+            logger.error("Error: %s" % error)
+            raise
+
+        return len(tuples)
+
+
+# TRANSACTIONS is range partitioned by TRANSACTION_DATE, one partition per month, created as batches need them.
+# A partitioned table's primary key has to include the partition key, so it is (TRANSACTION_ID, TRANSACTION_DATE);
+# transaction_ids keeps each transactionId unique across partitions (see claim_transaction_ids).
+create_transactions_table_query = """CREATE TABLE IF NOT EXISTS transactions
+    (
+CUSTOMER_ID VARCHAR (100) NOT NULL,
+TRANSACTION_ID VARCHAR (100) NOT NULL,
+TRANSACTION_DATE date NOT NULL,
+CURRENCY varchar(20),
+AMOUNT NUMERIC(18, 4),
+CREATED_ON timestamp,
+PRIMARY KEY (TRANSACTION_ID, TRANSACTION_DATE)
+    ) PARTITION BY RANGE (TRANSACTION_DATE);
+CREATE INDEX IF NOT EXISTS transactions_customer_id_idx ON transactions (CUSTOMER_ID, TRANSACTION_DATE);"""
+
+# Moves the rows of the unpartitioned table earlier versions created into the partitioned one, creating a
+# partition for every month they cover. Rows without a TRANSACTION_DATE cannot be partitioned; if there are
+# any, they are left in transactions_unpartitioned to be dealt with by hand.
+migrate_transactions_table_query = """ALTER TABLE transactions RENAME TO transactions_unpartitioned;
+ALTER INDEX IF EXISTS transactions_pkey RENAME TO transactions_unpartitioned_pkey;
+""" + create_transactions_table_query + """
+DO $$
+DECLARE first_day date;
+BEGIN
+    FOR first_day IN SELECT DISTINCT date_trunc('month', TRANSACTION_DATE)::date FROM transactions_unpartitioned
+                 WHERE TRANSACTION_DATE IS NOT NULL LOOP
+        EXECUTE format('CREATE TABLE IF NOT EXISTS %I PARTITION OF transactions FOR VALUES FROM (%L) TO (%L)',
+                       'transactions_' || to_char(first_day, '"y"YYYY"m"MM'), first_day, (first_day + interval '1 month')::date);
+    END LOOP;
+END $$;
+INSERT INTO transactions (CUSTOMER_ID,TRANSACTION_ID,TRANSACTION_DATE,CURRENCY,AMOUNT,CREATED_ON)
+    SELECT CUSTOMER_ID,TRANSACTION_ID,TRANSACTION_DATE,CURRENCY,AMOUNT,CREATED_ON FROM transactions_unpartitioned
+    WHERE TRANSACTION_DATE IS NOT NULL;
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM transactions_unpartitioned WHERE TRANSACTION_DATE IS NULL) THEN
+        DELETE FROM transactions_unpartitioned WHERE TRANSACTION_DATE IS NOT NULL;
+    ELSE
+        DROP TABLE transactions_unpartitioned;
+    END IF;
+END $$;"""
+
+
+def batch_months(df: pd.DataFrame) -> np.ndarray:
+    """
+    Returns the distinct months (datetime64[M]) of a batch's transactionDates, in order.
+    """
+
+    months = parse_dates(df["transactionDate"], date_fmt).to_numpy(dtype="datetime64[ns]").astype("datetime64[M]")
+
+    return np.unique(months[~np.isnat(months)])
+
+
+def transactions_schema_query(conn, months: np.ndarray) -> str:
+    """
+    Returns the statements bringing TRANSACTIONS up to date for a batch: the partitioned table and its
+    indexes (migrating an unpartitioned table if there is one), a partition for each of the batch's months
+    and the transaction_ids table.
+    """
 
+    with conn.cursor() as cur:
+        cur.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", ("transactions",))
+        row = cur.fetchone()
 
-def transaction_SQLtable_update(latest_file_date):
+    if row is not None and row[0] == "r":
+        get_run_logger().warning("TRANSACTIONS is not partitioned; migrating it to monthly partitions.")
+        queries = [migrate_transactions_table_query]
+    else:
+        queries = [create_transactions_table_query]
 
-    df_transactions = pd.read_csv(fr"data\final_data\transactions_only_transactions_{latest_file_date}.csv")
-    cols = "CUSTOMER_ID,TRANSACTION_ID,TRANSACTION_DATE,CURRENCY,AMOUNT,CREATED_ON"
+    for month in months:
+        first_day, next_first_day = np.datetime64(month, "D"), np.datetime64(month + 1, "D")
+        queries.append(f"CREATE TABLE IF NOT EXISTS transactions_{first_day.item():y%Ym%m} PARTITION OF transactions "
+                       f"FOR VALUES FROM ('{first_day}') TO ('{next_first_day}');")
 
-    table ="TRANSACTIONS"
+    queries.append(transaction_ids_table_query(conn))
 
-    create_table_query = """CREATE TABLE IF NOT EXISTS transactions
-        (
-    CUSTOMER_ID VARCHAR (100) NOT NULL , 
-    TRANSACTION_ID VARCHAR (100) NOT NULL PRIMARY KEY,
-    TRANSACTION_DATE date,
-    CURRENCY varchar(20),
-    AMOUNT DECIMAL(4),
-    CREATED_ON timestamp 
+    return "\n".join(queries) + "\n"
 
-        );"""
 
-    select_customers_query = f"SELECT * FROM {table}"
+def insert_transactions(conn, df_transactions: pd.DataFrame, cols: str, months: np.ndarray, create_table_query: str,
+                        wrap_merge: Optional[Callable[[str], str]] = None) -> int:
+    """
+    Inserts new transactions with the configured loader, first running create_table_query (see
+    transactions_schema_query). Transactions whose transactionId was loaded before, with any TRANSACTION_DATE,
+    are skipped (see claim_transaction_ids). Returns the number of rows inserted.
+    """
 
-    conn = psycopg2.connect("dbname='{db}' user='{user}' host='{host}' port='{port}' password='{passwd}'".format(
-                user="postgres",
-                passwd="password143",
-                host="localhost",
-                port="5432",
-                db="SNOOP_DATABASE"))
+    logger = get_run_logger()
+    table ="TRANSACTIONS"
+
+    # The batch's transactionIds are claimed in transaction_ids, via its primary key index; only the rows claimed are inserted.
+    claim_ids_query = (f"INSERT INTO {TRANSACTION_IDS_TABLE} (TRANSACTION_ID) SELECT DISTINCT unnest(%s::varchar[]) "
+                       f"ON CONFLICT (TRANSACTION_ID) DO NOTHING RETURNING TRANSACTION_ID")
+    target_filter = None
+    if months.shape[0] > 0:
+        first_day, end_day = np.datetime64(months[0], "D"), np.datetime64(months[-1] + 1, "D")
+        target_filter = f"t.TRANSACTION_DATE >= '{first_day}' AND t.TRANSACTION_DATE < '{end_day}'"
+
+    if use_copy_loader and parallel_load_workers > 1:
 
+        # The table is created over a separate, committed connection (see parallel_copy_SQLtable_update).
+        return parallel_copy_SQLtable_update(conn, df_transactions, table, cols, primary_key = "TRANSACTION_ID, TRANSACTION_DATE",
+                                             key = "transactionId", create_table_query = create_table_query,
+                                             wrap_merge = wrap_merge, target_filter = target_filter,
+                                             claim_keys = claim_transaction_ids)
 
     with conn.cursor() as cur:
 
         cur.execute(create_table_query)
-        conn.commit()
 
-        all_transaction_ids = []
+    if use_copy_loader:
+
+        return copy_SQLtable_update(conn, df_transactions, table, cols, primary_key = "TRANSACTION_ID, TRANSACTION_DATE",
+                                    wrap_merge = wrap_merge, target_filter = target_filter,
+                                    claim_keys = claim_transaction_ids)
+
+    with conn.cursor() as cur:
+
+        claimed_transaction_ids = []
 
         try:
-            cur.execute(select_customers_query)
+            cur.execute(claim_ids_query, (df_transactions["transactionId"].unique().tolist(),))
             all_records = cur.fetchall()    
             for row in all_records:
-                all_transaction_ids.append(row[1])
+                claimed_transaction_ids.append(row[0])
             
         except (Exception, psycopg2.DatabaseError) as error:
-            print("Error: %s" % error)
-            conn.rollback()
+            logger.error("Error: %s" % error)
+            raise
 
-        if len(all_transaction_ids) > 0:
+        if len(claimed_transaction_ids) < df_transactions.shape[0]:
 
-            df_transactions = df_transactions[~ df_transactions["transactionId"].isin(all_transaction_ids)]
-            print(df_transactions)
+            df_transactions = df_transactions[df_transactions["transactionId"].isin(claimed_transaction_ids)]
+            if logger.enabled("DEBUG"):
+                logger.debug("New transactions.", frame=df_transactions.to_string())
 
         if df_transactions.shape[0] == 0:
 
-            print("Transaction table already up to date.")
-            return
+            logger.info("Transaction table already up to date.")
+            return 0
 
-        tuples = list(set([tuple(x) for x in df_transactions.to_numpy()]))
-        
-        tuples_as_string = ""
-        # print(tuples_as_string)
+        tuples_as_string = values_list(cur, distinct_rows(df_transactions))
 
-        for x in tuples:
-            tuples_as_string += str(x) + ","
+        insert_records_query = f"INSERT INTO {table}({cols}) VALUES {tuples_as_string}" 
+        logger.debug("Insert query.", query=insert_records_query)
 
-        tuples_as_string = tuples_as_string[:-1]
+        try:
+            return execute_merge(cur, insert_records_query, wrap_merge)
+
+        except (Exception, psycopg2.DatabaseError) as error:
+            logger.error("Error: %s" % error)
+            raise
+
+
+def update_amended_transactions(conn, df_amended: pd.DataFrame, cols: str, rollup: bool) -> int:
+    """
+    Updates amended transactions in place: the rows are streamed through COPY into a temporary staging
+    table with the TRANSACTION_DATE each was last loaded with, and applied by one UPDATE matching the full
+    primary key, so only the partitions holding them are read. A row whose TRANSACTION_DATE changed moves
+    to its new partition. CREATED_ON keeps the time the transaction was first loaded.
+    Nothing is committed here. Returns the number of rows updated.
+
+    Parameters:
+    - conn: An open psycopg2 connection.
+    - df_amended (pd.DataFrame): The amended rows, with columns in the same order as cols, then previousTransactionDate.
+    - cols (str): Comma separated TRANSACTIONS column names.
+    - rollup (bool): Whether to move the rows' contributions in the rollup table (see with_amended_daily_rollup).
+    """
+
+    previous_months = np.unique(df_amended[PREVIOUS_DATE_COLUMN].to_numpy(dtype="datetime64[ns]").astype("datetime64[M]"))
+    first_day, end_day = np.datetime64(previous_months[0], "D"), np.datetime64(previous_months[-1] + 1, "D")
+
+    create_staging_query = (f"CREATE TEMP TABLE {AMENDED_STAGING_TABLE} (LIKE TRANSACTIONS INCLUDING DEFAULTS, "
+                            f"PREVIOUS_TRANSACTION_DATE date) ON COMMIT DROP")
+    copy_query = f"COPY {AMENDED_STAGING_TABLE} ({cols},PREVIOUS_TRANSACTION_DATE) FROM STDIN WITH (FORMAT csv)"
+    analyze_query = f"ANALYZE {AMENDED_STAGING_TABLE}"
+    update_query = f"""UPDATE TRANSACTIONS t
+        SET CUSTOMER_ID = s.CUSTOMER_ID, TRANSACTION_DATE = s.TRANSACTION_DATE, CURRENCY = s.CURRENCY, AMOUNT = s.AMOUNT
+        FROM {AMENDED_STAGING_TABLE} s
+        WHERE t.TRANSACTION_ID = s.TRANSACTION_ID AND t.TRANSACTION_DATE = s.PREVIOUS_TRANSACTION_DATE
+        AND t.TRANSACTION_DATE >= '{first_day}' AND t.TRANSACTION_DATE < '{end_day}'"""
+
+    logger = get_run_logger()
+    start = time.perf_counter()
+
+    with conn.cursor() as cur:
 
-        insert_records_query = f"INSERT INTO {table}({cols}) VALUES {tuples_as_string}" 
-        
         try:
-            cur.execute(insert_records_query)
-            conn.commit()
+            cur.execute(create_staging_query)
+            cur.copy_expert(copy_query, DataFrameCSVStream(df_amended))
+            cur.execute(analyze_query)
+            rows_updated = execute_merge(cur, update_query, with_amended_daily_rollup if rollup else None)
 
         except (Exception, psycopg2.DatabaseError) as error:
-            print("Error: %s" % error)
-            conn.rollback()
+            logger.error("Error: %s" % error)
+            raise
+
+    elapsed = time.perf_counter() - start
+
+    logger.info(f"TRANSACTIONS: updated {rows_updated} of {df_amended.shape[0]} amended rows in {elapsed:.2f}s.",
+                table="TRANSACTIONS", rows_amended=df_amended.shape[0], rows_updated=rows_updated, seconds=round(elapsed, 3))
+
+    return rows_updated
+
+
+def transaction_SQLtable_update(latest_file_date, conn, df_transactions = None):
+    """
+    Loads the day's transactions: new ones are inserted and amended ones updated (see transaction_state.py);
+    unchanged ones are not sent. Returns the number of rows inserted or updated.
+    """
+
+    logger = get_run_logger()
+    logger.set_stage("load_transactions")
+
+    # Read the day's transactions from final_data unless they were handed over in memory.
+    if df_transactions is None:
+        df_transactions = read_frame(final_data_path, f"transactions_only_transactions_{latest_file_date}",
+                                     columns = ["customerId", "transactionId", "transactionDate", "currency", "amount", "sourceDate", "createdOn"])
+    cols = "CUSTOMER_ID,TRANSACTION_ID,TRANSACTION_DATE,CURRENCY,AMOUNT,CREATED_ON"
+    load_columns = ["customerId", "transactionId", "transactionDate", "currency", "amount", "createdOn"]
+
+    df_transactions, df_amended = classify_transactions(df_transactions)
+    df_transactions = drop_known_rows(df_transactions, "transactions")
+
+    if df_transactions.shape[0] == 0 and df_amended.shape[0] == 0:
+
+        logger.info("Transaction table already up to date.")
+        return 0
+
+    # Amended rows may have moved to a month no partition exists for yet.
+    months = batch_months(pd.concat([df_transactions[["transactionDate"]], df_amended[["transactionDate"]]]))
+    create_table_query = transactions_schema_query(conn, months)
+
+    # The rollup is updated by the statement that inserts the transactions, so both commit or roll back together.
+    wrap_merge = None
+    if maintain_daily_rollup:
+        create_table_query += rollup_table_query(conn)
+        wrap_merge = with_daily_rollup
+
+    rows_written = 0
+
+    if df_transactions.shape[0] > 0:
+        rows_written += insert_transactions(conn, df_transactions[load_columns], cols, batch_months(df_transactions),
+                                            create_table_query, wrap_merge)
+    else:
+        with conn.cursor() as cur:
+            cur.execute(create_table_query)
 
+    # After the inserts: with the parallel loader, the partitions are created over another connection, which
+    # would wait for the locks an UPDATE in this transaction holds.
+    if df_amended.shape[0] > 0:
+        rows_written += update_amended_transactions(conn, df_amended[load_columns + [PREVIOUS_DATE_COLUMN]], cols,
+                                                    rollup = maintain_daily_rollup)
 
+    return rows_written
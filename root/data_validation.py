@@ -1,10 +1,19 @@
 import pandas as pd
-import os, json
-from helper_utils import (currency_type_counter, LoggerClass, get_latest_filename)
+import numpy as np
+import os, json, queue, threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from collections import Counter
+from helper_utils import (LoggerClass, iter_json_array, write_frame, set_run_logger, raw_parts, open_raw_file)
+from stage_metrics import StageMetrics
+from compact_schema import (to_compact_schema, from_compact_schema, concat_frames, memory_report, SOURCE_DATE_FORMAT)
+from date_parsing import parse_dates
+from out_of_core import (SpillPartitions, partitions_for_budget, restore_order)
+from validation_rules import (VALIDATION_RULES, DUPLICATE_ERROR_TYPE, duplicate_mask)
 from datetime import datetime
 import warnings
-from typing import Dict, Any, Tuple, List
-from config import (raw_data_path, removed_data_path, final_data_path, log_path, date_fmt, allowed_currency, REQUIRED_COLUMNS) 
+from typing import Tuple, List, Iterator
+from config import (raw_data_path, removed_data_path, final_data_path, date_fmt, allowed_currency, REQUIRED_COLUMNS, chunk_size, intermediate_format, write_csv_copy, write_final_data, compact_schema, out_of_core, validation_workers,
+                    raw_read_workers, raw_read_prefetch_chunks)
 
 
 # Remove Pandas warning.
@@ -12,31 +21,98 @@ from config import (raw_data_path, removed_data_path, final_data_path, log_path,
 from pandas.core.common import SettingWithCopyWarning
 warnings.simplefilter(action="ignore", category=SettingWithCopyWarning)
 
-# Pick up file from "S3" or local file system.
+# Set per processed file by run_all, so each file (and each worker process) logs to its own log
+# and metrics file. Until then, stage metrics are only kept in memory.
+Logger = None
+Metrics = StageMetrics(path = None, latest_filename = None)
 
-raw_data_path = r"data/raw_data/"
-removed_data_path = r"data/removed_data"
-final_data_path = r"data/final_data"
-log_path = r"data/logs/" # config
-date_fmt = '%Y-%m-%d' # config
-allowed_currency = ["GBP", "USD", "EUR"] # config
-REQUIRED_COLUMNS = "customerId","customerName","transactionId","transactionDate","sourceDate","merchantId","categoryId","currency","amount","description"
+def read_part_chunks(file_w_path: str, chunk_size: int = chunk_size) -> Iterator[pd.DataFrame]:
+    """
+    Streams the 'transactions' field of one raw file as DataFrames of at most chunk_size rows,
+    decompressing .gz files as they are read.
+    """
 
-latest_file = get_latest_filename(raw_data_path, date_fmt=date_fmt)
+    try:
+        with open_raw_file(file_w_path) as f:
+            records = []
+            for record in iter_json_array(f, "transactions"):
+                records.append(record)
+                if len(records) == chunk_size:
+                    yield pd.DataFrame(records)
+                    records = []
+            if records:
+                yield pd.DataFrame(records)
+    except json.JSONDecodeError as e:
+        raise json.JSONDecodeError(f"Error decoding JSON file: {file_w_path}", e.doc, e.pos) from e
 
-Logger = LoggerClass(path = "logs", latest_filename = latest_file)
 
-def read_json(path: str, file: str) -> Dict[str, Any]:
+def read_parts_concurrently(files_w_path: List[str], chunk_size: int = chunk_size, workers: int = raw_read_workers,
+                            prefetch_chunks: int = raw_read_prefetch_chunks) -> Iterator[pd.DataFrame]:
+    """
+    Yields the chunks of several raw files in file order, while up to workers of the files are read, decompressed
+    and parsed ahead in threads. Each file's reader stops prefetch_chunks ahead of the consumer, so memory stays
+    bounded whatever the number and size of the files. An error in any file is raised once its chunks are reached.
     """
 
-    Reads a JSON file from the specified path and returns the 'transactions' field.
+    stop = threading.Event()
+    chunk_queues = [queue.Queue(maxsize=prefetch_chunks) for _ in files_w_path]
+    end_of_file = object()
+
+    def put(chunk_queue, item):
+        # Gives up once the consumer is gone, so an abandoned read does not leave threads blocked.
+        while not stop.is_set():
+            try:
+                chunk_queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def read_file(position):
+        try:
+            for df in read_part_chunks(files_w_path[position], chunk_size):
+                if not put(chunk_queues[position], df):
+                    return
+            put(chunk_queues[position], end_of_file)
+        except Exception as error:
+            put(chunk_queues[position], error)
+
+    # Files are submitted in order, so the threads always work on the files the consumer needs next.
+    executor = ThreadPoolExecutor(max_workers=workers)
+
+    try:
+        for position in range(len(files_w_path)):
+            executor.submit(read_file, position)
+
+        for chunk_queue in chunk_queues:
+            while True:
+                item = chunk_queue.get()
+                if item is end_of_file:
+                    break
+                if isinstance(item, Exception):
+                    raise item
+                yield item
+
+    finally:
+        stop.set()
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def read_json_chunks(path: str, file: str, chunk_size: int = chunk_size) -> Iterator[pd.DataFrame]:
+    """
+
+    Streams the 'transactions' field of a day's JSON file(s) and yields it as DataFrames of at most chunk_size rows.
+    The file is never fully loaded, so memory use depends on chunk_size and not on the file size.
+    A day split into several (possibly gzip-compressed) part files is read part by part in order, with up to
+    raw_read_workers parts read ahead concurrently (see read_parts_concurrently).
 
     Params:
     - path (str): The path to the directory containing the JSON file.
-    - file (str): The name of the JSON file.
+    - file (str): The day file name (see helper_utils.raw_parts).
+    - chunk_size (int): The maximum number of transactions per DataFrame.
 
-    Returns:
-    - Dict[str, Any]: A dictionary containing the 'transactions' field from the JSON file.
+    Yields:
+    - pd.DataFrame: The next chunk of transactions.
 
     Raises:
     - FileNotFoundError: If the specified file is not found.
@@ -44,26 +120,32 @@ def read_json(path: str, file: str) -> Dict[str, Any]:
 
     """
     try:
-        with open(os.path.join(path, file), 'r') as f:
-            json_data = json.load(f)
-            transactions = json_data.get("transactions", [])
-            return transactions
+        files_w_path = [os.path.join(path, part) for part in raw_parts(path, file)]
+        if not files_w_path:
+            raise FileNotFoundError(os.path.join(path, file))
+
+        if len(files_w_path) == 1 or raw_read_workers <= 1:
+            for file_w_path in files_w_path:
+                yield from read_part_chunks(file_w_path, chunk_size)
+        else:
+            yield from read_parts_concurrently(files_w_path, chunk_size, min(raw_read_workers, len(files_w_path)))
     except FileNotFoundError as e:
-        Logger.logging_function("File error!")
+        Logger.error("File error!")
         raise FileNotFoundError(f"File not found: {os.path.join(path, file)}") from e
-    except json.JSONDecodeError as e:
-        Logger.logging_function("JSON error!")
-        raise json.JSONDecodeError(f"Error decoding JSON file: {os.path.join(path, file)}") from e
+    except json.JSONDecodeError:
+        Logger.error("JSON error!")
+        raise
 
 
-
-def initial_df_quality_checks(df : pd.DataFrame):
+def initial_df_quality_checks(df : pd.DataFrame, log_summary: bool = True):
     """
     Performs initial quality checks on a DataFrame.
     Each step is explained within the function.
 
     Parameters:
     - df (pd.DataFrame): The DataFrame to perform quality checks on.
+    - log_summary (bool): Whether to log the row count and column descriptions. Set to False when checking
+      chunks of a file, where the summary is logged once for the whole file.
 
     Returns:
     - pd.DataFrame: The DataFrame with renamed columns if necessary.
@@ -73,14 +155,12 @@ def initial_df_quality_checks(df : pd.DataFrame):
 
     """
 
-    global REQUIRED_COLUMNS
-
     r,c = df.shape
 
     # Stops processing if file has zero rows.
     if r == 0:
 
-        Logger.logging_function("ERROR: File is empty. Exiting.")
+        Logger.error("File is empty. Exiting.")
         raise Exception("File is empty. Exiting.")
         exit()
     
@@ -93,7 +173,7 @@ def initial_df_quality_checks(df : pd.DataFrame):
 
         message = "Number of columns in latest transactions does not match requirements. Exiting!"
 
-        Logger.logging_function(f"ERROR: {message}")
+        Logger.error(message)
         raise Exception(f"{message}")
         exit()
     
@@ -110,7 +190,7 @@ def initial_df_quality_checks(df : pd.DataFrame):
 
         # If column names cannot be reordered, then error is raised.
         message = "Columns names do not match. Exiting!"
-        Logger.logging_function(f"ERROR: {message}")
+        Logger.error(message)
         raise Exception(f"{message}")
 
     else:
@@ -118,131 +198,280 @@ def initial_df_quality_checks(df : pd.DataFrame):
         # If no errir raised, then columns are renamed as per requirements.
         df = df.rename(columns={old_col_name : new_col_name for old_col_name, new_col_name in zip(df.columns, REQUIRED_COLUMNS)})
 
-    row_text = f"Total number of rows in raw file: {r}"
-    column_text = f"Total number of columns: {c}"
+    if log_summary:
+        log_raw_file_summary(df, r)
 
-    Logger.logging_function(row_text)
-    Logger.logging_function(column_text)
+    return df
+
+
+def log_raw_file_summary(df: pd.DataFrame, total_rows: int):
+    """
+    Logs the number of rows and a description of the columns of the raw file.
+
+    Parameters:
+    - df (pd.DataFrame): The (renamed) DataFrame, or the first chunk of it, to describe the columns of.
+    - total_rows (int): The total number of rows in the raw file.
+    """
+
+    row_text = f"Total number of rows in raw file: {total_rows}"
+    column_text = f"Total number of columns: {df.shape[1]}"
+
+    Logger.info(row_text, rows=int(total_rows))
+    Logger.info(column_text, columns=int(df.shape[1]))
 
     col_desc_text = ""
 
-    for n,col in enumerate(df_columns, 1):
+    for n,col in enumerate(df.columns, 1):
 
         dtype_str = str(df[f"{col}"].dtype)
         col_desc_text += f"Column {str(n)}  -->\tName: {col}, DataType : {dtype_str} \n"
 
-    Logger.logging_function(col_desc_text)
+    Logger.info(col_desc_text)
 
-    return df
 
 
+def split_rejected_rows(df: pd.DataFrame, mask: pd.Series, error_type: str, latest_filename: str) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Splits a DataFrame into kept and rejected rows using a rejection mask, tagging the rejected rows.
+
+    Parameters:
+    - df (pd.DataFrame): The DataFrame to split.
+    - mask (pd.Series): Boolean mask, True for rejected rows.
+    - error_type (str or pd.Series): The error type recorded against the rejected rows.
+    - latest_filename (str): The name of the latest file being processed.
+
+    Returns:
+    - Tuple[pd.DataFrame, pd.DataFrame]: The kept rows (re-indexed) and the rejected rows.
+    """
+
+    kept_df = df[~mask].reset_index(drop=True)
+
+    rejected_df = df[mask].copy()
+    rejected_df["ErrorType"] = error_type
+    rejected_df["FileName"] = latest_filename
+
+    return kept_df, rejected_df
+
 
-def validate_currency(df: pd.DataFrame, allowed_currency: List[str], latest_filename: str) -> Tuple[pd.DataFrame, pd.DataFrame]:
+def handle_duplicates(df: pd.DataFrame, latest_filename: str) -> Tuple[pd.DataFrame, pd.DataFrame]:
     """
-    Validate currency types in a DataFrame against a list of allowed currencies.
+    Handle duplicates in a DataFrame based on the 'transactionId' column and 'sourceDate'.
+    Please note: The transaction with the latest sourceDate is kept as we're assuming that the latest sourceDate 
+    gives the most up to date (amended) record.
 
     Parameters:
-    - df (pd.DataFrame): The DataFrame to validate.
-    - allowed_currency (List[str]): List of allowed currency types.
+    - df (pd.DataFrame): The DataFrame to handle duplicates in.
     - latest_filename (str): The name of the latest file being processed.
 
     Returns:
     - Tuple[pd.DataFrame, pd.DataFrame]: A tuple containing two DataFrames -
-      1. DataFrame with rows containing valid currencies.
-      2. DataFrame with rows containing invalid currencies.
+      1. DataFrame with duplicates removed based on the latest 'sourceDate'.
+      2. DataFrame with rows containing removed duplicate entries.
+    """
+
+    source_date = parse_dates(df["sourceDate"])
+    mask = duplicate_mask(df, source_date = source_date)
+
+    duplicate_rows_log = f"Found {mask.sum()} duplicate rows (removed)." 
+    Logger.info(duplicate_rows_log)
 
+    df, df_removed_duplicates = split_rejected_rows(df, mask, DUPLICATE_ERROR_TYPE, latest_filename)
+    df["sourceDate"] = source_date[~mask].to_numpy()
+
+    return df, df_removed_duplicates
+
+
+def handle_duplicates_out_of_core(spill: SpillPartitions, latest_filename: str) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Same as handle_duplicates on the concatenation of every spilled chunk, but resolved one partition at a
+    time: a transactionId's rows all share a partition, so only one partition is in memory while it is
+    deduplicated. The kept and removed rows are returned in the same order as handle_duplicates returns them.
+
+    Parameters:
+    - spill (SpillPartitions): The spilled valid rows.
+    - latest_filename (str): The name of the latest file being processed.
+
+    Returns:
+    - Tuple[pd.DataFrame, pd.DataFrame]: The deduplicated rows and the removed duplicate rows.
     """
 
-    valid_currency_df = df.loc[  df['currency'].isin(allowed_currency) ] 
-    valid_currency_df = valid_currency_df.reset_index(drop=True)
+    kept_frames, removed_frames = [], []
+
+    for partition in range(spill.partitions):
+
+        df = spill.read_partition(partition)
+        if df.shape[0] == 0:
+            continue
 
-    invalid_currency_df = df.loc[~ df['currency'].isin(allowed_currency)] 
+        source_date = parse_dates(df["sourceDate"])
+        mask = duplicate_mask(df, source_date = source_date)
 
-    invalid_currency_log = currency_type_counter(invalid_currency_df)
-    Logger.logging_function(invalid_currency_log)
+        df_kept, df_removed = split_rejected_rows(df, mask, DUPLICATE_ERROR_TYPE, latest_filename)
+        df_kept["sourceDate"] = source_date[~mask].to_numpy()
 
-    invalid_currency_df["ErrorType"] = "INCORRECT CURRENCY = " + invalid_currency_df["currency"]
-    invalid_currency_df["FileName"] = latest_file
+        kept_frames.append(df_kept)
+        removed_frames.append(df_removed)
+
+    df, df_removed_duplicates = restore_order(kept_frames), restore_order(removed_frames)
+
+    Logger.info(f"Found {df_removed_duplicates.shape[0]} duplicate rows (removed).")
+
+    return df, df_removed_duplicates
 
-    return valid_currency_df, invalid_currency_df
 
-def check_invalid_transaction_date(df: pd.DataFrame, date_fmt: str, latest_filename: str) -> Tuple[pd.DataFrame, pd.DataFrame]:
+def apply_validation_rules(df: pd.DataFrame, latest_filename: str) -> Tuple[pd.DataFrame, pd.DataFrame]:
     """
-    Check the validity of transaction dates in a DataFrame based on a specified date format.
+    Applies every rule in validation_rules.VALIDATION_RULES, then duplicate resolution, in a single pass.
+    Each rule only produces a boolean mask over the same frame; the masks are combined and the frame is
+    split into valid and rejected rows once. A rejected row carries the error types of every rule it fails,
+    separated by "; ". Duplicates are resolved among the rows that pass every other rule.
 
     Parameters:
-    - df (pd.DataFrame): The DataFrame to check.
-    - date_fmt (str): The expected date format for the 'transactionDate' column.
+    - df (pd.DataFrame): The DataFrame to validate.
     - latest_filename (str): The name of the latest file being processed.
 
     Returns:
     - Tuple[pd.DataFrame, pd.DataFrame]: A tuple containing two DataFrames -
-      1. DataFrame with rows containing correctly formatted dates.
-      2. DataFrame with rows containing incorrectly formatted dates.
+      1. DataFrame with the valid rows.
+      2. DataFrame with the rejected rows, with ErrorType and FileName columns.
     """
 
-    df['transactionDateErrorCheck'] = pd.to_datetime(df['transactionDate'],format= date_fmt, errors='coerce')
+    rejected = np.zeros(df.shape[0], dtype=bool)
+    failures = []
 
-    correct_datefmt_df = df[~df['transactionDateErrorCheck'].isna()] # NOT NAN
-    correct_datefmt_df = correct_datefmt_df.drop(columns=['transactionDateErrorCheck'])
-    correct_datefmt_df = correct_datefmt_df.reset_index(drop=True)
+    # transactionDate is parsed once, for its rule and for the valid output (convert_dtypes keeps it as it is).
+    # The rules see the parsed column; rejected rows keep the raw text.
+    df_parsed = df.copy(deep=False)
+    df_parsed["transactionDate"] = parse_dates(df["transactionDate"], date_fmt)
 
-    incorrect_datefmt_df = df[df['transactionDateErrorCheck'].isna()]
-    incorrect_datefmt_df = incorrect_datefmt_df.drop(columns=['transactionDateErrorCheck'])
-    incorrect_datefmt_df["ErrorType"] = "INCORRECT DATE FORMAT"
-    incorrect_datefmt_df["FileName"] = latest_file
+    for name, rule, error_type in VALIDATION_RULES:
 
-    num_of_rows = incorrect_datefmt_df.shape[0]
+        mask = rule(df_parsed)
+        if mask is None:
+            continue
 
-    incorrect_date_log = f"Found {num_of_rows} incorrect date rows (removed)." 
-    Logger.logging_function(incorrect_date_log)
+        mask = mask.to_numpy(dtype=bool)
+        rejected |= mask
+        failures.append((mask, error_type))
 
-    return correct_datefmt_df, incorrect_datefmt_df
+    # sourceDate is parsed once, for both duplicate resolution and the valid output.
+    source_date = parse_dates(df["sourceDate"])
 
+    dup_mask = duplicate_mask(df_parsed, pd.Series(~rejected, index=df.index), source_date).to_numpy()
+    rejected |= dup_mask
 
-def handle_duplicates(df: pd.DataFrame, latest_filename: str) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    df_valid = df_parsed[~rejected].reset_index(drop=True)
+    df_valid["sourceDate"] = source_date[~rejected].to_numpy()
+
+    df_rejected = df[rejected].copy()
+    error_types = pd.Series("", index=df_rejected.index, dtype=object)
+
+    for mask, error_type in failures:
+
+        failed = mask[rejected]
+        if not failed.any():
+            if isinstance(error_type, str):
+                Logger.info(f"Found 0 rows with {error_type} (removed).", rows=0, error_type=error_type)
+            continue
+
+        codes = error_type if isinstance(error_type, str) else error_type(df_rejected[failed])
+        previous = error_types[failed]
+        error_types[failed] = np.where(previous == "", codes, previous + "; " + codes)
+
+        counts = {codes: int(failed.sum())} if isinstance(codes, str) else Counter(codes)
+        for code, num_of_rows in counts.items():
+            Logger.info(f"Found {num_of_rows} rows with {code} (removed).", rows=int(num_of_rows), error_type=code)
+
+    error_types[dup_mask[rejected]] = DUPLICATE_ERROR_TYPE
+    Logger.info(f"Found {dup_mask.sum()} duplicate rows (removed).", rows=int(dup_mask.sum()), error_type=DUPLICATE_ERROR_TYPE)
+
+    df_rejected["ErrorType"] = error_types
+    df_rejected["FileName"] = latest_filename
+
+    return df_valid, df_rejected
+
+
+def validate_partition(spill: SpillPartitions, partition: int, latest_filename: str) -> Tuple[int, int]:
+    """
+    Runs apply_validation_rules on one whole spilled partition, in a worker process. As a transactionId's rows
+    all share a partition, this also resolves every duplicate. The partition is read from its memory-mapped
+    Arrow files and the valid and rejected rows are written next to it, so no DataFrame is pickled.
+    Returns the number of valid and rejected rows.
     """
-    Handle duplicates in a DataFrame based on the 'transactionId' column and 'sourceDate'.
-    Please note: The transaction with the latest sourceDate is kept as we're assuming that the latest sourceDate 
-    gives the most up to date (amended) record.
+
+    global Logger, Metrics
+
+    # The rejected rows are counted and logged by the parent once every partition is done. The logger is closed
+    # before returning, as a pool worker exits without running atexit (Metrics has no path, so keeps nothing).
+    Logger = LoggerClass(path = None, latest_filename = latest_filename, level = "ERROR")
+    Metrics = StageMetrics(path = None, latest_filename = latest_filename)
+
+    from pyarrow import feather
+
+    try:
+        df = spill.read_partition(partition)
+        if df.shape[0] == 0:
+            return 0, 0
+
+        df_v, df_i = apply_validation_rules(df, latest_filename)
+
+        feather.write_feather(df_v, spill.result_file(partition, "valid"), compression="uncompressed")
+        feather.write_feather(df_i.reset_index(drop=True), spill.result_file(partition, "removed"), compression="uncompressed")
+
+    finally:
+        Logger.close()
+
+    return df_v.shape[0], df_i.shape[0]
+
+
+def validate_partitions_in_parallel(spill: SpillPartitions, latest_filename: str, workers: int = validation_workers) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Validates the spilled partitions of a file in a pool of worker processes (see validate_partition) and
+    merges their outputs deterministically: valid and rejected rows are both put back in file order.
+    Rejected rows are counted per error type and logged here, once for the whole file.
 
     Parameters:
-    - df (pd.DataFrame): The DataFrame to handle duplicates in.
+    - spill (SpillPartitions): The spilled rows, after initial_df_quality_checks (and to_compact_schema).
     - latest_filename (str): The name of the latest file being processed.
+    - workers (int): The number of worker processes.
 
     Returns:
-    - Tuple[pd.DataFrame, pd.DataFrame]: A tuple containing two DataFrames -
-      1. DataFrame with duplicates removed based on the latest 'sourceDate'.
-      2. DataFrame with rows containing removed duplicate entries.
+    - Tuple[pd.DataFrame, pd.DataFrame]: The valid rows and the rejected rows, with ErrorType and FileName columns.
     """
 
-    df_all_duplicates_only = df[df.duplicated(subset = ["transactionId"], keep=False)]
-    df_all_duplicates_only['sourceDate'] = pd.to_datetime(df_all_duplicates_only['sourceDate'], errors='coerce')
+    from pyarrow import feather
 
-    # Keep duplicate entry based on latest Source Date.
+    partitions = list(range(spill.partitions))
 
-    df_latest_dup_entry = df_all_duplicates_only.sort_values(by = ['transactionId',"sourceDate"], ascending=True)
-    df_latest_dup_entry = df_latest_dup_entry.drop_duplicates(subset = ["transactionId"], keep="last")
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        counts = list(executor.map(validate_partition, [spill] * len(partitions), partitions, [latest_filename] * len(partitions)))
 
-    # Separate DataFrame of duplicate entries removed.
+    valid_frames, removed_frames = [], []
 
-    df_removed_duplicates = df_all_duplicates_only[~df_all_duplicates_only.isin(df_latest_dup_entry).any(axis=1)]
-    df_removed_duplicates["ErrorType"] = "DUPLICATE VALUE (Removed from final DataFrame)"
-    df_removed_duplicates["FileName"] = latest_file
+    for partition, (valid_rows, removed_rows) in zip(partitions, counts):
+        if valid_rows + removed_rows == 0:
+            continue
+        valid_frames.append(feather.read_feather(spill.result_file(partition, "valid"), memory_map=True))
+        removed_frames.append(feather.read_feather(spill.result_file(partition, "removed"), memory_map=True))
 
-    num_of_rows = df_removed_duplicates.shape[0]
+    df_v, df_i = restore_order(valid_frames), restore_order(removed_frames)
 
-    duplicate_rows_log = f"Found {num_of_rows} duplicate rows (removed)." 
-    Logger.logging_function(duplicate_rows_log)
+    error_type_counts = Counter()
+    for error_types in df_i.get("ErrorType", pd.Series(dtype=object)):
+        error_type_counts.update(error_types.split("; "))
 
-    # df_latest_dup_entry.to_csv(r'data\final_data\check_duplicates.csv', index = False)
-    
-    df['sourceDate'] = pd.to_datetime(df['sourceDate'], errors='coerce')
-    df = df.sort_values(by = ['transactionId',"sourceDate"], ascending=True)
-    df = df.drop_duplicates(subset = ["transactionId"], keep="last")
-    df = df.reset_index(drop=True)
+    for name, rule, error_type in VALIDATION_RULES:
+        if isinstance(error_type, str):
+            error_type_counts.setdefault(error_type, 0)
 
-    return df, df_removed_duplicates
+    for code, num_of_rows in error_type_counts.items():
+        if code != DUPLICATE_ERROR_TYPE:
+            Logger.info(f"Found {num_of_rows} rows with {code} (removed).", rows=int(num_of_rows), error_type=code)
+
+    num_of_duplicates = error_type_counts.get(DUPLICATE_ERROR_TYPE, 0)
+    Logger.info(f"Found {num_of_duplicates} duplicate rows (removed).", rows=int(num_of_duplicates), error_type=DUPLICATE_ERROR_TYPE)
+
+    return df_v, df_i
 
 
 def convert_dtypes(df: pd.DataFrame, date_fmt: str) -> pd.DataFrame:
@@ -257,7 +486,7 @@ def convert_dtypes(df: pd.DataFrame, date_fmt: str) -> pd.DataFrame:
     - pd.DataFrame: The DataFrame with converted data types.
     """
 
-    df["transactionDate"] = pd.to_datetime(df['transactionDate'],format = date_fmt, errors='coerce')
+    df["transactionDate"] = parse_dates(df["transactionDate"], date_fmt)
     df["amount"] = df["amount"].astype(float)
     return df
 
@@ -266,45 +495,189 @@ def run_all_validation_checks(
     latest_file: str,
     date_fmt: str,
     removed_data_path: str,
-    final_data_path: str
+    final_data_path: str,
+    write_output: bool = write_final_data,
+    raw_data_path: str = raw_data_path
 ) -> pd.DataFrame:
     """
     Run a series of validation checks on a JSON file of transactions.
+    The file is streamed in chunks of chunk_size rows (see config.py). The validation rules run per chunk in a
+    single pass (see apply_validation_rules) and removed rows are appended to the removed data CSV as they are found.
+    Duplicates are resolved within each chunk and then once more across the valid rows of all chunks,
+    as a transactionId may span chunks. With out_of_core set, the valid rows are spilled to disk meanwhile
+    and the cross-chunk duplicates are resolved one partition at a time (see out_of_core.py).
+    With validation_workers above 1, the chunks are only quality checked and spilled, and the partitions are
+    then validated and deduplicated in a process pool (see validate_partitions_in_parallel).
 
     Parameters:
     - allowed_currency (List[str]): List of allowed currency types.
     - latest_file (str): The name of the latest JSON file being processed.
     - date_fmt (str): The expected date format for the 'transactionDate' column.
     - removed_data_path (str): The path to store the removed data CSV files.
-    - final_data_path (str): The path to store the final validated data CSV file.
+    - final_data_path (str): The path to store the final validated data file.
+    - write_output (bool): Whether to write the validated data file. Removed rows are always written.
+    - raw_data_path (str): The directory of the raw JSON file.
 
     Returns:
     - pd.DataFrame: The DataFrame with validated data.
     """
 
-    transactions_json = read_json(path = raw_data_path, file = latest_file)
+    filename_without_ext = latest_file.replace(".json", "")
+    removed_file = os.path.join(removed_data_path, f"removed_rows_{filename_without_ext}.csv")
+
+    # Removed rows are streamed to CSV chunk by chunk; the columnar file needs all of them, so they are kept.
+    stream_removed_csv = intermediate_format == "csv" or write_csv_copy
+    removed_chunks = []
+
+    valid_chunks = []
+    first_chunk = None
+    total_rows = 0
+    removed_header = True
+
+    # The compact layout is fixed by the first chunk; a later chunk it cannot represent switches the rest of
+    # the file to the regular representation (see compact_schema.py).
+    use_compact_schema = compact_schema
+    layout = None
+
+    parallel = validation_workers > 1
+    spill = None
+    if out_of_core or parallel:
+        partitions = partitions_for_budget([os.path.join(raw_data_path, part) for part in raw_parts(raw_data_path, latest_file)])
+        if parallel:
+            partitions = max(partitions, validation_workers)
+        spill = SpillPartitions(latest_file, partitions)
+        Logger.info(f"Spilling rows to {partitions} partition(s) by transactionId.", partitions=partitions)
+
+    chunks = read_json_chunks(path = raw_data_path, file = latest_file, chunk_size = chunk_size)
+
+    for df in Metrics.timed_iter("read_json", chunks):
+
+        with Metrics.stage("quality_checks", rows_in = df.shape[0]) as stage:
+            df = initial_df_quality_checks(df, log_summary = False)
+            stage["rows_out"] = df.shape[0]
+
+        if use_compact_schema:
+            with Metrics.stage("compact_schema", rows_in = df.shape[0]):
+                df_compact, layout = to_compact_schema(df, layout)
+            if df_compact is None:
+                Logger.info(f"Chunk starting at row {total_rows} does not fit the compact schema of {', '.join(sorted(layout))}: "
+                            "the rest of the file is processed in the regular schema.")
+                use_compact_schema = False
+            elif first_chunk is None:
+                Logger.info(memory_report(df, df_compact))
+
+        if first_chunk is None:
+            first_chunk = df.head()
+        total_rows += df.shape[0]
+
+        if use_compact_schema:
+            df = df_compact
+
+        if parallel:
+            with Metrics.stage("spill", rows_in = df.shape[0]):
+                spill.spill(df)
+            continue
+
+        with Metrics.stage("validation_rules", rows_in = df.shape[0]) as stage:
+            df_v, df_i = apply_validation_rules(df, latest_file)
+            stage["rows_out"] = df_v.shape[0]
+
+        if compact_schema:
+            df_i = from_compact_schema(df_i, raw_text = ("amount", "sourceDate"))
+
+        if spill is not None:
+            with Metrics.stage("spill", rows_in = df_v.shape[0]):
+                spill.spill(df_v)
+        else:
+            valid_chunks.append(df_v)
+
+        with Metrics.stage("write_removed", rows_in = df_i.shape[0]):
+            if stream_removed_csv:
+                df_i.to_csv(removed_file, index=False, mode="w" if removed_header else "a", header=removed_header)
+                removed_header = False
+            if intermediate_format != "csv":
+                removed_chunks.append(df_i)
 
-    df = pd.DataFrame(transactions_json);
+    # Stops processing if file has zero rows.
+    if total_rows == 0:
 
-    df = initial_df_quality_checks(df)
+        Logger.error("File is empty. Exiting.")
+        if spill is not None:
+            spill.cleanup()
+        raise Exception("File is empty. Exiting.")
 
-    df_v, df_i1 = validate_currency(df, allowed_currency, latest_file)
-    df_v ,df_i2 = check_invalid_transaction_date(df_v, date_fmt, latest_file)
-    df_v ,df_i3 = handle_duplicates(df_v, latest_file)
-    df_v = convert_dtypes(df_v, date_fmt)
+    log_raw_file_summary(first_chunk, total_rows)
 
-    df_i = pd.concat([df_i1, df_i2, df_i3])
+    # Rows removed after the per-chunk pass: every rejected row in parallel mode, cross-chunk duplicates otherwise.
+    df_i4 = None
 
-    filename_without_ext = latest_file.replace(".json", "")
-    
-    df_v.to_csv(os.path.join(final_data_path, f"validated_{filename_without_ext}.csv"), index=False)
-    df_i.to_csv(os.path.join(removed_data_path, f"removed_rows_{filename_without_ext}.csv"), index=False)
+    if parallel:
+        with Metrics.stage("validation_rules", rows_in = spill.rows) as stage:
+            df_v, df_i4 = validate_partitions_in_parallel(spill, latest_file)
+            stage["rows_out"] = df_v.shape[0]
+        spill.cleanup()
+
+    # Resolve duplicates whose rows landed in different chunks.
+    elif spill is not None:
+        if spill.chunks > 1:
+            with Metrics.stage("cross_chunk_duplicates", rows_in = spill.rows) as stage:
+                df_v, df_i4 = handle_duplicates_out_of_core(spill, latest_file)
+                stage["rows_out"] = df_v.shape[0]
+        else:
+            df_v = restore_order([spill.read_partition(partition) for partition in range(spill.partitions)])
+        spill.cleanup()
+
+    else:
+        df_v = concat_frames(valid_chunks)
+        if len(valid_chunks) > 1:
+            with Metrics.stage("cross_chunk_duplicates", rows_in = df_v.shape[0]) as stage:
+                df_v, df_i4 = handle_duplicates(df_v, latest_file)
+                stage["rows_out"] = df_v.shape[0]
+
+    if df_i4 is not None:
+        if compact_schema:
+            df_i4 = from_compact_schema(df_i4, raw_text = ("amount", "sourceDate"))
+        # Cross-chunk duplicates are valid rows, with transactionDate and sourceDate parsed; removed rows keep them as text.
+        for col, fmt in (("transactionDate", date_fmt), ("sourceDate", SOURCE_DATE_FORMAT)):
+            if pd.api.types.is_datetime64_any_dtype(df_i4[col].dtype):
+                df_i4[col] = df_i4[col].dt.strftime(fmt)
+        with Metrics.stage("write_removed", rows_in = df_i4.shape[0]):
+            if stream_removed_csv:
+                df_i4.to_csv(removed_file, index=False, mode="w" if removed_header else "a", header=removed_header)
+            if intermediate_format != "csv":
+                removed_chunks.append(df_i4)
+
+    with Metrics.stage("convert_dtypes", rows_in = df_v.shape[0]):
+        if compact_schema:
+            df_v = from_compact_schema(df_v)
+        df_v = convert_dtypes(df_v, date_fmt)
+
+    if intermediate_format != "csv":
+        with Metrics.stage("write_removed"):
+            # Removed rows keep their raw text values, so they are stored as strings.
+            df_i = pd.concat(removed_chunks, ignore_index=True)
+            write_frame(df_i.astype(str).where(df_i.notna(), None), removed_data_path, f"removed_rows_{filename_without_ext}", fmt=intermediate_format)
+
+    if write_output:
+        with Metrics.stage("write_validated", rows_in = df_v.shape[0]):
+            write_frame(df_v, final_data_path, f"validated_{filename_without_ext}")
         
     return df_v
 
 
 
-def create_customer_df(df):
+def create_customer_df(df: pd.DataFrame, latest_file: str, write_output: bool = write_final_data) -> pd.DataFrame:
+    """
+    Builds the customers to load from the validated DataFrame, optionally writing them to final_data.
+
+    Parameters:
+    - df (pd.DataFrame): The validated DataFrame.
+    - latest_file (str): The name of the raw JSON file being processed.
+    - write_output (bool): Whether to write the customers file to final_data.
+
+    Returns:
+    - pd.DataFrame: The customerId, customerName and createdOn columns.
+    """
 
     customers_df = df[["customerId", "customerName"]]
     customers_df = customers_df.drop_duplicates(subset=["customerId", "customerName"])
@@ -313,23 +686,71 @@ def create_customer_df(df):
 
     filename_without_ext = latest_file.replace(".json", "")
 
-    customers_df.to_csv(os.path.join(final_data_path,f"customers_only_{filename_without_ext}.csv"), index=False)
+    if write_output:
+        write_frame(customers_df, final_data_path, f"customers_only_{filename_without_ext}")
+
+    return customers_df
+
+
+def create_transactions_df(df: pd.DataFrame, latest_file: str, write_output: bool = write_final_data) -> pd.DataFrame:
+    """
+    Builds the transactions to load from the validated DataFrame, optionally writing them to final_data.
 
+    Parameters:
+    - df (pd.DataFrame): The validated DataFrame.
+    - latest_file (str): The name of the raw JSON file being processed.
+    - write_output (bool): Whether to write the transactions file to final_data.
 
-def create_transactions_df(df):
+    Returns:
+    - pd.DataFrame: The customerId, transactionId, transactionDate, currency, amount, sourceDate and createdOn columns.
+      sourceDate is not loaded; it tells amended transactions apart (see transaction_state.py).
+    """
     
-    transactions_df = df[["customerId", "transactionId", "transactionDate", "currency","amount"]]
+    transactions_df = df[["customerId", "transactionId", "transactionDate", "currency","amount", "sourceDate"]]
     transactions_df["createdOn"] = pd.to_datetime(datetime.now(),format="%Y-%m-%d")
 
     filename_without_ext = latest_file.replace(".json", "")
 
-    transactions_df.to_csv(os.path.join(final_data_path,f"transactions_only_{filename_without_ext}.csv"), index=False)
+    if write_output:
+        write_frame(transactions_df, final_data_path, f"transactions_only_{filename_without_ext}")
 
+    return transactions_df
 
-def run_all():    
 
-    df_v = run_all_validation_checks(allowed_currency, latest_file, date_fmt, removed_data_path, final_data_path)
-    create_customer_df(df_v)
-    create_transactions_df(df_v)
+def run_all(file: str, write_output: bool = write_final_data) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Validates one raw file and returns the customers and transactions to load, so they can be handed
+    to data_to_postgredb in memory. Removed rows are always written to removed_data; the final_data
+    files are only written when write_output is set.
+    Safe to call from a worker process: each call logs to the file's own log.
+
+    Parameters:
+    - file (str): The name of the raw JSON file to process.
+    - write_output (bool): Whether to write the validated, customers and transactions files to final_data.
+
+    Returns:
+    - Tuple[pd.DataFrame, pd.DataFrame]: The customers and transactions DataFrames.
+    """
 
-run_all()
\ No newline at end of file
+    global Logger, Metrics
+    Logger = LoggerClass(path = "logs", latest_filename = file)
+    Metrics = StageMetrics(path = "logs", latest_filename = file)
+    set_run_logger(Logger)
+
+    try:
+        Logger.set_stage("validation")
+        df_v = run_all_validation_checks(allowed_currency, file, date_fmt, removed_data_path, final_data_path, write_output)
+
+        Logger.set_stage("final_data")
+        with Metrics.stage("create_customers", rows_in = df_v.shape[0]) as stage:
+            customers_df = create_customer_df(df_v, file, write_output)
+            stage["rows_out"] = customers_df.shape[0]
+        with Metrics.stage("create_transactions", rows_in = df_v.shape[0]) as stage:
+            transactions_df = create_transactions_df(df_v, file, write_output)
+            stage["rows_out"] = transactions_df.shape[0]
+
+    finally:
+        Metrics.write()
+        Logger.close()
+
+    return customers_df, transactions_df
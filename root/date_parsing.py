@@ -0,0 +1,122 @@
+import numpy as np
+import pandas as pd
+from typing import Optional
+
+
+# Shared date parsing for transactionDate and sourceDate. A file holds millions of transactionDates but only
+# a few thousand distinct ones, so each distinct value is parsed once and the results are mapped back to the
+# rows through their factorized codes. Values in the two formats the raw files use are parsed by numpy in bulk;
+# anything else (and any value numpy rejects) goes through pd.to_datetime, so the results are the same as
+# calling pd.to_datetime(values, format=fmt, errors="coerce") on the whole column.
+
+# format -> (layout, numpy unit). In a layout "d" stands for a digit; other characters must match exactly.
+FAST_FORMATS = {
+    "%Y-%m-%d": ("dddd-dd-dd", "datetime64[D]"),
+    "%Y-%m-%dT%H:%M:%S": ("dddd-dd-ddTdd:dd:dd", "datetime64[s]"),
+}
+# The fast path only takes years datetime64[ns] can hold: the first two digits must be 17 to 21.
+CENTURY_RANGE = (17, 21)
+# Without a format, values are first tried as sourceDate's ISO format.
+DEFAULT_FAST_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+SAMPLE_ROWS = 10000
+MAX_DISTINCT_SHARE = 0.5
+
+
+def matches_layout(values: np.ndarray, layout: str) -> np.ndarray:
+    """
+    Returns a boolean array, True where a value is a string of exactly the given layout.
+    Checked on the raw bytes, without a Python level loop.
+    """
+
+    width = len(layout)
+
+    # One byte more than the layout, so longer values can be told apart. Non-string values become their
+    # repr (e.g. b"None") and never match.
+    try:
+        chars = np.asarray(values, dtype=f"S{width + 1}").view(np.uint8).reshape(-1, width + 1)
+    except UnicodeEncodeError:
+        return np.zeros(values.shape[0], dtype=bool)
+
+    digits = np.array([position for position, char in enumerate(layout) if char == "d"])
+    separators = np.array([position for position, char in enumerate(layout) if char != "d"])
+
+    matches = chars[:, width] == 0
+    matches &= ((chars[:, digits] >= ord("0")) & (chars[:, digits] <= ord("9"))).all(axis=1)
+    matches &= (chars[:, separators] == np.frombuffer(layout.encode(), dtype=np.uint8)[separators]).all(axis=1)
+
+    century = (chars[:, 0].astype(int) - ord("0")) * 10 + chars[:, 1] - ord("0")
+    matches &= (century >= CENTURY_RANGE[0]) & (century <= CENTURY_RANGE[1])
+
+    return matches
+
+
+def parse_values(values: np.ndarray, fmt: Optional[str] = None) -> np.ndarray:
+    """
+    Parses an array of values: those in a FAST_FORMATS layout with numpy, in bulk, the others with pd.to_datetime.
+
+    Parameters:
+    - values (np.ndarray): The values, usually strings.
+    - fmt (str): The strptime format, or None to infer it like pd.to_datetime.
+
+    Returns:
+    - np.ndarray: datetime64[ns] values, NaT where a value does not parse.
+    """
+
+    result = np.full(values.shape[0], np.datetime64("NaT"), dtype="datetime64[ns]")
+    rest = np.ones(values.shape[0], dtype=bool)
+
+    layout, unit = FAST_FORMATS.get(fmt or DEFAULT_FAST_FORMAT, (None, None))
+
+    if layout is not None:
+
+        fast = matches_layout(values, layout)
+
+        try:
+            result[fast] = values[fast].astype(unit).astype("datetime64[ns]")
+            rest = ~fast
+        except ValueError:
+            # e.g. "2022-02-30": leave every value to pd.to_datetime.
+            pass
+
+    if rest.any():
+        result[rest] = pd.to_datetime(pd.Series(values[rest], dtype=object), format=fmt, errors="coerce").to_numpy(dtype="datetime64[ns]")
+
+    return result
+
+
+def parse_dates(values: pd.Series, fmt: Optional[str] = None) -> pd.Series:
+    """
+    Parses a column of dates with parse_values. Each distinct value is only parsed once, unless the column has
+    (judging by its first SAMPLE_ROWS rows) so many distinct values that factorizing it would cost more than
+    parsing every row, e.g. sourceDate, which is to the second.
+    Columns that are already datetime64 are returned as they are.
+
+    Parameters:
+    - values (pd.Series): The column to parse.
+    - fmt (str): The strptime format, or None to infer it like pd.to_datetime.
+
+    Returns:
+    - pd.Series: datetime64[ns] values with the same index, NaT where a value does not parse.
+    """
+
+    if pd.api.types.is_datetime64_any_dtype(values.dtype):
+        return values
+
+    if isinstance(values.dtype, pd.CategoricalDtype):
+        codes, uniques = values.cat.codes.to_numpy(), values.cat.categories.to_numpy(dtype=object)
+
+    else:
+        array = values.to_numpy(dtype=object)
+        sample = array[:SAMPLE_ROWS]
+
+        if pd.unique(sample).shape[0] > sample.shape[0] * MAX_DISTINCT_SHARE:
+            return pd.Series(parse_values(array, fmt), index=values.index)
+
+        codes, uniques = pd.factorize(array)
+        uniques = np.asarray(uniques, dtype=object)
+
+    parsed = np.append(parse_values(uniques, fmt), np.datetime64("NaT", "ns"))
+
+    # Missing values have code -1, which picks the trailing NaT.
+    return pd.Series(parsed[codes], index=values.index)
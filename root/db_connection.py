@@ -0,0 +1,82 @@
+import time
+from contextlib import contextmanager
+from helper_utils import get_run_logger
+from config import (db_config, db_pool_min_connections, db_pool_max_connections)
+
+
+connection_pool = None
+
+
+def get_connection_pool():
+    """
+    Returns the process wide connection pool, creating it on first use.
+    The time taken to open the pool's initial connections is reported.
+
+    Returns:
+    - psycopg2.pool.ThreadedConnectionPool: The connection pool.
+    """
+
+    global connection_pool
+
+    if connection_pool is None:
+
+        # Imported here so that importing this module stays cheap.
+        from psycopg2 import pool
+
+        start = time.perf_counter()
+        connection_pool = pool.ThreadedConnectionPool(db_pool_min_connections, db_pool_max_connections, **db_config)
+        elapsed = time.perf_counter() - start
+
+        get_run_logger().info(f"Opened connection pool to {db_config['host']}:{db_config['port']}/{db_config['dbname']} "
+                              f"({db_pool_min_connections} connection(s)) in {elapsed:.3f}s.", seconds=round(elapsed, 4))
+
+    return connection_pool
+
+
+@contextmanager
+def db_transaction():
+    """
+    Borrows a connection from the pool for the duration of one transaction.
+    The transaction is committed if the block completes and rolled back if it raises,
+    so a run never leaves part of its data loaded.
+
+    Yields:
+    - psycopg2.extensions.connection: A connection with an open transaction.
+    """
+
+    import psycopg2
+
+    conn_pool = get_connection_pool()
+
+    start = time.perf_counter()
+    conn = conn_pool.getconn()
+    if conn.closed:
+        # Pooled connections outlive the server's idle timeouts and restarts in watch mode.
+        conn_pool.putconn(conn, close=True)
+        conn = conn_pool.getconn()
+    elapsed = time.perf_counter() - start
+    get_run_logger().info(f"Acquired database connection in {elapsed:.3f}s.", seconds=round(elapsed, 4))
+
+    try:
+        yield conn
+        conn.commit()
+
+    except (Exception, psycopg2.DatabaseError) as error:
+        get_run_logger().error("Error: %s - rolling back." % error)
+        conn.rollback()
+        raise
+
+    finally:
+        conn_pool.putconn(conn)
+
+
+def close_connection_pool():
+    """
+    Closes every connection in the pool. The pool is recreated on the next call to get_connection_pool.
+    """
+
+    global connection_pool
+
+    if connection_pool is not None:
+        connection_pool.closeall()
+        connection_pool = None
@@ -0,0 +1,129 @@
+import os
+import queue
+import threading
+from helper_utils import (raw_file_index, load_processed_manifest, get_run_logger)
+from config import (raw_data_path, processed_manifest_path, watch_poll_seconds, watch_queue_size)
+
+
+# Watch mode (run_main.py --watch): a background thread polls raw_data_path and hands each new raw file
+# to the processing loop through a bounded queue. When the queue is full the watcher blocks instead of
+# scanning further, so a burst of drops is worked through one file at a time and never starts overlapping runs.
+# A day is only queued once its files (see helper_utils.raw_parts) and their sizes and modification times are
+# unchanged between two polls, so a file still being written, or a day whose parts are still arriving, is not
+# picked up half way. Parts arriving after their day was processed are not picked up.
+
+
+class RawFileWatcher():
+    """
+    Polls a directory for raw transactions files missing from the processed-files manifest and queues them,
+    oldest first within each scan. A file whose processing failed is not queued again until it changes.
+    """
+
+    def __init__(self, path = raw_data_path, manifest_path = processed_manifest_path,
+                 queue_size = watch_queue_size, poll_seconds = watch_poll_seconds) -> None:
+
+        self.path = path
+        self.manifest_path = manifest_path
+        self.poll_seconds = poll_seconds
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="raw-file-watcher", daemon=True)
+
+        # day file -> ((part, size, mtime_ns), ...) at the previous poll, of the days queued or being processed,
+        # and of the days whose processing failed.
+        self.last_seen = {}
+        self.in_progress = {}
+        self.failed = {}
+        self.lock = threading.Lock()
+
+    def scan(self):
+        """
+        Returns the day files ready to be queued, sorted by date.
+        """
+
+        processed = load_processed_manifest(self.manifest_path)
+        seen, ready = {}, []
+
+        for file, parts in raw_file_index(self.path).items():
+
+            if file in processed:
+                continue
+
+            stats = [os.stat(os.path.join(self.path, part)) for part in parts]
+            seen[file] = signature = tuple((part, stat.st_size, stat.st_mtime_ns) for part, stat in zip(parts, stats))
+
+            with self.lock:
+                waiting = file in self.in_progress or self.failed.get(file) == signature
+
+            if not waiting and self.last_seen.get(file) == signature:
+                ready.append(file)
+
+        self.last_seen = seen
+
+        # Day file names sort by date.
+        return sorted(ready)
+
+    def put(self, file) -> bool:
+        """
+        Queues a file, blocking while the queue is full. Returns False if the watcher was stopped meanwhile.
+        """
+
+        with self.lock:
+            self.in_progress[file] = self.last_seen[file]
+            self.failed.pop(file, None)
+
+        while not self.stop_event.is_set():
+            try:
+                self.queue.put(file, timeout=self.poll_seconds)
+                return True
+            except queue.Full:
+                continue
+
+        return False
+
+    def run(self):
+
+        while not self.stop_event.is_set():
+
+            try:
+                for file in self.scan():
+                    if not self.put(file):
+                        return
+                    get_run_logger().info(f"Watch: queued {file} ({self.queue.qsize()} waiting).")
+
+            except OSError as error:
+                # e.g. raw_data_path briefly unavailable: try again at the next poll.
+                get_run_logger().error("Watch: could not scan %s: %s" % (self.path, error))
+
+            self.stop_event.wait(self.poll_seconds)
+
+    def start(self):
+
+        self.thread.start()
+
+    def stop(self):
+
+        self.stop_event.set()
+        self.thread.join()
+
+    def next_file(self):
+        """
+        Returns the next queued file, or None if none arrived within one poll interval.
+        """
+
+        try:
+            return self.queue.get(timeout=self.poll_seconds)
+        except queue.Empty:
+            return None
+
+    def done(self, file, failed = False):
+        """
+        Releases a file taken with next_file. A failed file is retried once its size or modification time changes.
+        """
+
+        with self.lock:
+            signature = self.in_progress.pop(file)
+            if failed:
+                self.failed[file] = signature
+
+        self.queue.task_done()
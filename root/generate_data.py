@@ -0,0 +1,219 @@
+import argparse
+import os
+import numpy as np
+import pandas as pd
+from compact_schema import pair_to_uuid
+from config import (benchmark_path, allowed_currency)
+
+
+# Synthetic raw files in the same schema as transactions_YYYY_MM_DD.json, for benchmarking.
+
+INVALID_CURRENCIES = ["JPY", "INR", "JPN"]
+INVALID_DATES = ["process error", "2022/02/30", "21-02-2022", ""]
+MERCHANTS = ["Blair-White", "Sherman-Love", "Anderson, Thomas and Jimenez", "Hobbs-Perez", "Castillo and Sons",
+             "Pennington-White", "Bryant PLC", "Garcia LLC", "Miller Group", "Payne Inc"]
+CATEGORIES = ["Travel", "Shopping", "Eating Out", "Finances", "Health & Beauty", "Transport",
+              "Groceries", "Bills", "Entertainment", "General"]
+FIRST_NAMES = ["Gregory", "Blake", "Courtney", "Cassidy", "Marcus", "Justin", "Amy", "Laura", "Daniel", "Sofia"]
+LAST_NAMES = ["Downs", "Smith", "Castillo", "Garcia", "Miller", "Payne", "Jones", "Brown", "Wilson", "Taylor"]
+
+FIRST_DATE = np.datetime64("2020-01-01")
+LAST_DATE = np.datetime64("2024-01-01")
+
+# The columns a duplicate copies from its original row.
+HISTORY_COLUMNS = ["transactionId", "customerId", "customerName", "sourceDate"]
+
+
+def synthetic_filename(rows):
+    """
+    Returns the raw file name used for a synthetic file of the given size. The files are dated in 1999,
+    one day per order of magnitude, so they sort by size and never clash with real files.
+    """
+
+    return f"transactions_1999_01_{len(str(rows)):02d}.json"
+
+
+def random_uuids(rng, n):
+    """
+    Returns n random UUID strings.
+    """
+
+    return pair_to_uuid(rng.integers(0, 2**64, n, dtype=np.uint64), rng.integers(0, 2**64, n, dtype=np.uint64))
+
+
+def make_chunk(rng, rows, customers, bad_currency_rate, bad_date_rate, duplicate_rate, history = None, earlier_rows = 0):
+    """
+    Builds one chunk of synthetic transactions.
+
+    Parameters:
+    - rng (np.random.Generator): The random generator.
+    - rows (int): The number of rows.
+    - customers (pd.DataFrame): The customer pool (customerId, customerName).
+    - bad_currency_rate (float): Share of rows with a currency that is not allowed.
+    - bad_date_rate (float): Share of rows with a malformed transactionDate.
+    - duplicate_rate (float): Share of rows repeating an earlier transaction of the file with a later sourceDate.
+    - history (pd.DataFrame): A uniform sample of the file's earlier rows (see update_history), None for the first chunk.
+    - earlier_rows (int): The number of rows written before this chunk.
+
+    Returns:
+    - pd.DataFrame: The chunk, with the raw file's columns and types.
+    """
+
+    customer = rng.integers(0, customers.shape[0], rows)
+    transaction_ids = random_uuids(rng, rows)
+
+    days = int((LAST_DATE - FIRST_DATE).astype(int))
+    transaction_date = FIRST_DATE + rng.integers(0, days, rows).astype("timedelta64[D]")
+    source_date = transaction_date.astype("datetime64[s]") + rng.integers(0, 10 * 86400, rows).astype("timedelta64[s]")
+
+    merchant = rng.integers(0, len(MERCHANTS), rows)
+    category = rng.integers(0, len(CATEGORIES), rows)
+    description = np.char.add(np.char.add(np.array(MERCHANTS)[merchant], " | "), np.array(CATEGORIES)[category])
+
+    currency = np.array(allowed_currency)[rng.integers(0, len(allowed_currency), rows)].astype(object)
+    bad_currency = rng.random(rows) < bad_currency_rate
+    currency[bad_currency] = np.array(INVALID_CURRENCIES)[rng.integers(0, len(INVALID_CURRENCIES), bad_currency.sum())]
+
+    transaction_date = np.datetime_as_string(transaction_date, unit="D").astype(object)
+    bad_date = rng.random(rows) < bad_date_rate
+    transaction_date[bad_date] = np.array(INVALID_DATES)[rng.integers(0, len(INVALID_DATES), bad_date.sum())]
+
+    customer_id = customers["customerId"].to_numpy()[customer]
+    customer_name = customers["customerName"].to_numpy()[customer]
+
+    # Duplicates copy an earlier row's transaction (and customer) and are amended a few hours later. The earlier row
+    # is any row of the file before it: one of an earlier chunk is taken from the history sample.
+    if history is None:
+        earlier_rows = 0
+    duplicate = np.flatnonzero(rng.random(rows) < duplicate_rate)
+    duplicate = duplicate[earlier_rows + duplicate > 0]
+    original = (rng.random(duplicate.shape[0]) * (earlier_rows + duplicate)).astype(np.int64) - earlier_rows
+
+    in_chunk = original >= 0
+    for values in (transaction_ids, customer_id, customer_name, source_date):
+        values[duplicate[in_chunk]] = values[original[in_chunk]]
+
+    if history is not None:
+        sampled = rng.integers(0, history.shape[0], (~in_chunk).sum())
+        transaction_ids[duplicate[~in_chunk]] = history["transactionId"].to_numpy()[sampled]
+        customer_id[duplicate[~in_chunk]] = history["customerId"].to_numpy()[sampled]
+        customer_name[duplicate[~in_chunk]] = history["customerName"].to_numpy()[sampled]
+        source_date[duplicate[~in_chunk]] = history["sourceDate"].to_numpy()[sampled].astype("datetime64[s]")
+
+    source_date[duplicate] += rng.integers(1, 86400, duplicate.shape[0]).astype("timedelta64[s]")
+
+    return pd.DataFrame({
+        "customerId": customer_id,
+        "customerName": customer_name,
+        "transactionId": transaction_ids,
+        "transactionDate": transaction_date,
+        "sourceDate": np.datetime_as_string(source_date, unit="s"),
+        "merchantId": merchant * 10 + rng.integers(0, 10, rows),
+        "categoryId": category + 1,
+        "currency": currency,
+        "amount": np.char.mod("%.2f", np.round(rng.normal(0, 1000, rows), 2)),
+        "description": description,
+    })
+
+
+def update_history(rng, history, chunk, earlier_rows, size):
+    """
+    Keeps a uniform sample of at most size rows of the file so far (reservoir sampling), from which make_chunk draws
+    the originals of cross-chunk duplicates, so memory use does not grow with rows.
+
+    Parameters:
+    - rng (np.random.Generator): The random generator.
+    - history (pd.DataFrame): The sample of the rows before chunk, None before the first chunk.
+    - chunk (pd.DataFrame): The chunk just built by make_chunk.
+    - earlier_rows (int): The number of rows before chunk.
+    - size (int): The size of the sample.
+
+    Returns:
+    - pd.DataFrame: The sample of the rows up to and including chunk.
+    """
+
+    rows = chunk[HISTORY_COLUMNS]
+
+    if history is None:
+        history = rows.iloc[:0]
+    if history.shape[0] < size:
+        fill = min(size - history.shape[0], rows.shape[0])
+        history, rows, earlier_rows = pd.concat([history, rows.iloc[:fill]], ignore_index=True), rows.iloc[fill:], earlier_rows + fill
+
+    # Row number t of the file replaces a random slot with probability size / (t + 1).
+    slot = (rng.random(rows.shape[0]) * (earlier_rows + np.arange(1, rows.shape[0] + 1))).astype(np.int64)
+    kept = slot < size
+    history.iloc[slot[kept]] = rows[kept].to_numpy(dtype=object)
+
+    return history
+
+
+def generate_file(path, file, rows, bad_currency_rate = 0.002, bad_date_rate = 0.001, duplicate_rate = 0.01,
+                  chunk_rows = 100000, seed = 0):
+    """
+    Writes a synthetic raw file of the given size, chunk by chunk, so memory use does not grow with rows.
+
+    Parameters:
+    - path (str): The output directory.
+    - file (str): The output file name, e.g. 'transactions_2024_02_01.json'.
+    - rows (int): The number of transactions.
+    - bad_currency_rate, bad_date_rate, duplicate_rate (float): See make_chunk.
+    - chunk_rows (int): Rows generated and written at a time.
+    - seed (int): Seed of the random generator, so files are reproducible.
+
+    Returns:
+    - str: The path of the written file.
+    """
+
+    rng = np.random.default_rng(seed)
+
+    # Roughly 240 transactions per customer, as in the sample file.
+    n_customers = max(1, rows // 240)
+    customers = pd.DataFrame({
+        "customerId": random_uuids(rng, n_customers),
+        "customerName": np.char.add(np.char.add(np.array(FIRST_NAMES)[rng.integers(0, len(FIRST_NAMES), n_customers)], " "),
+                                    np.array(LAST_NAMES)[rng.integers(0, len(LAST_NAMES), n_customers)]),
+    })
+
+    file_w_path = os.path.join(path, file)
+
+    with open(file_w_path, 'w') as f:
+
+        f.write('{\n    "transactions": [\n')
+
+        history = None
+
+        for n, start in enumerate(range(0, rows, chunk_rows)):
+
+            chunk = make_chunk(rng, min(chunk_rows, rows - start), customers, bad_currency_rate, bad_date_rate, duplicate_rate,
+                               history, start)
+            history = update_history(rng, history, chunk, start, chunk_rows)
+            records = chunk.to_json(orient="records")
+
+            if n > 0:
+                f.write(",\n")
+            f.write(records[1:-1])
+
+        f.write('\n    ]\n}\n')
+
+    return file_w_path
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Generate synthetic raw transactions files for benchmarking.")
+    parser.add_argument("--rows", type=int, nargs="+", default=[100_000, 1_000_000, 10_000_000])
+    parser.add_argument("--path", default=os.path.join(benchmark_path, "raw_data"))
+    parser.add_argument("--bad-currency-rate", type=float, default=0.002)
+    parser.add_argument("--bad-date-rate", type=float, default=0.001)
+    parser.add_argument("--duplicate-rate", type=float, default=0.01)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    os.makedirs(args.path, exist_ok=True)
+
+    for rows in args.rows:
+
+        file = synthetic_filename(rows)
+        generate_file(args.path, file, rows, args.bad_currency_rate, args.bad_date_rate, args.duplicate_rate, seed=args.seed)
+        print(f"Wrote {rows:,} rows to {os.path.join(args.path, file)}.")
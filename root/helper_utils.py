@@ -1,7 +1,7 @@
 from collections import Counter
-import pandas as pd
-import os
+import os, re, sys, json, gzip, time, atexit
 from datetime import datetime
+from config import (intermediate_format, write_csv_copy, log_level, log_buffer_size, raw_index_path)
 
 currency_allowed = ["GBP", "USD", "EUR"]
 
@@ -45,12 +45,14 @@ def null_check(df):
 
     l_rows, c_rows = len(rows_with_nulls), len(cols_with_nulls)
 
+    logger = get_run_logger()
+
     if not len(rows_with_nulls):
-        print(f"No nulls found.")
+        logger.info("No nulls found.")
         return 0
     else:
-        print(f"Nulls present in table in rows: {rows_with_nulls}.")
-        print(f"Nulls present in table in columns: {cols_with_nulls}.")
+        logger.warning(f"Nulls present in table in {l_rows} rows and {c_rows} columns: {cols_with_nulls}.")
+        logger.debug("Rows with nulls.", rows=rows_with_nulls)
 
 
         dict_results =  {
@@ -75,33 +77,411 @@ def currency_type_counter(invalid_currency_df):
     return final_log
         
 class LoggerClass():
+    """
+    Buffered run logger writing one JSON object per line, with a level, the raw file being processed
+    and the current pipeline stage. Records are kept in memory and written in batches of buffer_size,
+    at every stage boundary (set_stage) and at exit. Without a path, records go to stdout.
+    """
+
+    LEVELS = {"DEBUG": 10, "INFO": 20, "WARNING": 30, "ERROR": 40}
 
-    def __init__(self, path, latest_filename) -> None:
+    def __init__(self, path, latest_filename, level = log_level, buffer_size = log_buffer_size, overwrite = True) -> None:
 
         self.path = path
-        self.filename = "log_" + latest_filename.replace(".json", ".log")
-        self.file_w_path = os.path.join(self.path, self.filename)
+        self.latest_filename = latest_filename
+        self.level = self.LEVELS[level.upper()]
+        self.buffer_size = buffer_size
+        self.buffer = []
+        self.stage = None
+        self.file_w_path = None
+
+        if path is not None:
+
+            self.filename = "log_" + latest_filename.replace(".json", ".log")
+            self.file_w_path = os.path.join(self.path, self.filename)
+
+            if overwrite and os.path.exists(self.file_w_path):
+                os.remove(self.file_w_path)
+
+        atexit.register(self.flush)
+
+    def enabled(self, level):
+
+        return self.LEVELS[level] >= self.level
+
+    def log(self, level, message, **fields):
+        """
+        Buffers one record. Extra keyword arguments are added to the JSON object as they are.
+        """
+
+        if not self.enabled(level):
+            return
+
+        record = {"time": datetime.now().isoformat(timespec="milliseconds"), "level": level,
+                  "file": self.latest_filename, "stage": self.stage, "message": message}
+        record.update(fields)
 
-        if os.path.exists(self.file_w_path):
-            os.remove(self.file_w_path)
+        self.buffer.append(json.dumps(record, default=str))
+
+        if len(self.buffer) >= self.buffer_size:
+            self.flush()
+
+    def debug(self, message, **fields):
+        self.log("DEBUG", message, **fields)
+
+    def info(self, message, **fields):
+        self.log("INFO", message, **fields)
+
+    def warning(self, message, **fields):
+        self.log("WARNING", message, **fields)
+
+    def error(self, message, **fields):
+        self.log("ERROR", message, **fields)
 
     def logging_function(self, log_text):
 
-        with open(self.file_w_path, 'a') as f:
+        self.info(log_text)
 
-            f.write("\n")
-            f.write(log_text)
+    def set_stage(self, stage):
+        """
+        Marks a stage boundary: flushes the buffered records and tags the following ones with stage.
+        """
 
-def get_latest_filename(raw_data_path, date_fmt):
+        self.flush()
+        self.stage = stage
 
-    all_files = os.listdir(raw_data_path)
-    all_dates = []  
+    def close(self):
+        """
+        Flushes the remaining records. The logger should not be used afterwards.
+        """
 
-    for file in all_files:
-        
-        file = file.replace(".json", "")
-        file_date = list(map(int, file.split("_")[1:]))
-        date_ = datetime(*file_date)
-        all_dates.append(date_)
+        self.flush()
+        atexit.unregister(self.flush)
+
+    def flush(self):
+
+        if not self.buffer:
+            return
+
+        text = "\n".join(self.buffer) + "\n"
+        self.buffer = []
+
+        if self.file_w_path is None:
+            sys.stdout.write(text)
+            sys.stdout.flush()
+        else:
+            with open(self.file_w_path, 'a') as f:
+                f.write(text)
+
+
+# The logger of the file currently being processed, shared by the validation and loading modules.
+run_logger = None
+
+
+def set_run_logger(logger):
+
+    global run_logger
+    run_logger = logger
+
+
+def get_run_logger():
+    """
+    Returns the logger of the file currently being processed, or a stdout logger if there is none.
+    """
+
+    global run_logger
+
+    if run_logger is None:
+        run_logger = LoggerClass(path = None, latest_filename = None, buffer_size = 1)
+
+    return run_logger
+
+
+# A day's transactions arrive as transactions_YYYY_MM_DD.json, optionally gzip-compressed (.json.gz) and/or
+# split into numbered parts (transactions_YYYY_MM_DD_NN.json[.gz]). The pipeline handles a day under its
+# plain name, transactions_YYYY_MM_DD.json, whatever files it is stored in (see raw_parts).
+raw_filename_pattern = re.compile(r"^transactions_(\d{4})_(\d{2})_(\d{2})(?:_\d+)?\.json(?:\.gz)?$")
+raw_part_pattern = re.compile(r"^transactions_\d{4}_\d{2}_\d{2}_(\d+)\.json")
+
+# A directory listing is only trusted by the raw file index once the directory has been unchanged for this
+# long, as a file added within the resolution of its modification time would not change it.
+RAW_INDEX_SETTLE_NS = 2 * 10**9
+
+raw_indexes = {}
+
+
+def get_file_date(filename):
+    """
+    Returns the date part of a raw file name, e.g. 'transactions_2024_01_07.json' -> '2024_01_07'.
+    """
+
+    return "_".join(filename.replace(".json", "").split("_")[1:])
+
+
+def day_filename(part_filename):
+    """
+    Returns the name a day is handled under for one of its raw files, e.g.
+    'transactions_2024_01_07_03.json.gz' -> 'transactions_2024_01_07.json', or None for other files.
+    """
+
+    match = raw_filename_pattern.match(part_filename)
+    if match is None:
+        return None
 
-    return "transactions" + "_" +  max(all_dates).strftime(date_fmt.replace("-", "_")) + ".json"
\ No newline at end of file
+    return "transactions_%s_%s_%s.json" % match.groups()
+
+
+def part_order(part_filename):
+    """
+    Sort key of a day's raw files: the unsplit file first, then the parts by number.
+    """
+
+    match = raw_part_pattern.match(part_filename)
+
+    return (-1 if match is None else int(match.group(1)), part_filename)
+
+
+def raw_file_index(raw_data_path, index_path = raw_index_path):
+    """
+    Returns the raw files of a directory grouped by day: {day file name: [file names, in part order]}.
+    The grouping is kept in memory and in index_path, and the directory is only listed again once its
+    modification time (which changes whenever a file is added, removed or renamed) differs from the one indexed.
+    """
+
+    directory = os.path.abspath(raw_data_path)
+    mtime_ns = os.stat(directory).st_mtime_ns
+
+    if directory not in raw_indexes and index_path and os.path.exists(index_path):
+        with open(index_path, 'r') as f:
+            raw_indexes.update(json.load(f))
+
+    index = raw_indexes.get(directory)
+    if index is not None and index["mtime_ns"] == mtime_ns:
+        return index["files"]
+
+    files = {}
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            day = day_filename(entry.name)
+            if day is not None:
+                files.setdefault(day, []).append(entry.name)
+
+    for parts in files.values():
+        parts.sort(key=part_order)
+
+    # A directory modified just now may still change within the same modification time: list it again next time.
+    if time.time_ns() - mtime_ns > RAW_INDEX_SETTLE_NS:
+        raw_indexes[directory] = {"mtime_ns": mtime_ns, "files": files}
+
+        if index_path:
+            # Written under a per-process name first: catch-up workers may rewrite the index concurrently.
+            os.makedirs(os.path.dirname(index_path) or ".", exist_ok=True)
+            tmp_path = f"{index_path}.{os.getpid()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump(raw_indexes, f)
+            os.replace(tmp_path, index_path)
+
+    return files
+
+
+def raw_parts(raw_data_path, file):
+    """
+    Returns the files a day is stored in (see raw_filename_pattern), in part order, or an empty list.
+    """
+
+    return raw_file_index(raw_data_path).get(file, [])
+
+
+def open_raw_file(file_w_path):
+    """
+    Opens a raw file as text, decompressing .gz files as they are read.
+    """
+
+    if file_w_path.endswith(".gz"):
+        return gzip.open(file_w_path, 'rt')
+
+    return open(file_w_path, 'r')
+
+
+def raw_file_size(file_w_path):
+    """
+    Returns the uncompressed size of a raw file. For .gz files it is read from the gzip trailer, which holds
+    it modulo 4 GiB, so larger parts are underestimated.
+    """
+
+    if not file_w_path.endswith(".gz"):
+        return os.path.getsize(file_w_path)
+
+    with open(file_w_path, 'rb') as f:
+        f.seek(-4, os.SEEK_END)
+        return int.from_bytes(f.read(4), "little")
+
+
+def load_processed_manifest(manifest_path):
+    """
+    Reads the processed-files manifest, a JSON object mapping each processed raw file name
+    to the time it was loaded. Returns an empty manifest if none exists yet.
+    """
+
+    if not os.path.exists(manifest_path):
+        return {}
+
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def mark_file_processed(manifest_path, filename):
+    """
+    Records a raw file as fully loaded in the processed-files manifest.
+    The manifest is rewritten atomically so an interrupted run cannot corrupt it.
+    """
+
+    manifest = load_processed_manifest(manifest_path)
+    manifest[filename] = datetime.now().isoformat(timespec="seconds")
+
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def get_unprocessed_filenames(raw_data_path, manifest_path):
+    """
+    Lists every raw transactions file that is not in the processed-files manifest, oldest first.
+
+    Parameters:
+    - raw_data_path (str): The directory holding the raw JSON files.
+    - manifest_path (str): The path of the processed-files manifest.
+
+    Returns:
+    - list: Day file names (see raw_file_index) sorted by date.
+    """
+
+    processed = load_processed_manifest(manifest_path)
+
+    # Day file names sort by date.
+    return sorted(file for file in raw_file_index(raw_data_path) if file not in processed)
+
+
+def get_latest_filename(raw_data_path, date_fmt):
+    """
+    Returns the day file name (see raw_file_index) of the latest day in raw_data_path.
+    """
+
+    files = raw_file_index(raw_data_path)
+    if not files:
+        raise FileNotFoundError(f"No raw transactions files in {raw_data_path}")
+
+    return max(files)
+
+
+def iter_json_array(f, key, read_size = 1 << 16):
+    """
+    Walks a JSON array stored under a top-level key and yields its elements one at a time,
+    without loading the whole document into memory.
+
+    Parameters:
+    - f: An open text file object.
+    - key (str): The name of the top-level key holding the array (e.g. 'transactions').
+    - read_size (int): Number of characters read from the file at a time.
+
+    Yields:
+    - Any: Each decoded element of the array.
+
+    Raises:
+    - json.JSONDecodeError: If an element of the array cannot be decoded.
+    """
+
+    decoder = json.JSONDecoder()
+    key_pattern = re.compile(r'"' + re.escape(key) + r'"\s*:\s*\[')
+
+    buffer = ""
+    eof = False
+
+    # Find the start of the array, keeping enough of the buffer to match a key split across reads.
+    while True:
+        match = key_pattern.search(buffer)
+        if match:
+            pos = match.end()
+            break
+        if eof:
+            return
+        chunk = f.read(read_size)
+        eof = not chunk
+        buffer = buffer[-(len(key) + 64):] + chunk
+
+    while True:
+
+        # Skip whitespace and separators between elements.
+        while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+            pos += 1
+
+        if pos == len(buffer):
+            if eof:
+                raise json.JSONDecodeError(f"Unterminated '{key}' array", buffer, pos)
+            chunk = f.read(read_size)
+            eof = not chunk
+            buffer, pos = buffer[pos:] + chunk, 0
+            continue
+
+        if buffer[pos] == "]":
+            return
+
+        try:
+            element, pos = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            # The element may be cut off at the end of the buffer; read more and retry.
+            if eof:
+                raise
+            chunk = f.read(read_size)
+            eof = not chunk
+            buffer, pos = buffer[pos:] + chunk, 0
+            continue
+
+        yield element
+
+
+def write_frame(df, directory, name, fmt = intermediate_format):
+    """
+    Writes an intermediate DataFrame (final or removed data) in the configured format.
+    'feather' writes an uncompressed Arrow IPC file, which keeps the dtypes and can be memory-mapped
+    by read_frame. A CSV copy is also written for human inspection when write_csv_copy is set.
+
+    Parameters:
+    - df (pd.DataFrame): The DataFrame to write.
+    - directory (str): The output directory.
+    - name (str): The file name without extension.
+    - fmt (str): 'feather' or 'csv'.
+    """
+
+    if fmt == "feather":
+        from pyarrow import feather
+        feather.write_feather(df.reset_index(drop=True), os.path.join(directory, f"{name}.feather"), compression="uncompressed")
+
+    if fmt == "csv" or write_csv_copy:
+        df.to_csv(os.path.join(directory, f"{name}.csv"), index=False)
+
+
+def read_frame(directory, name, columns = None, fmt = intermediate_format):
+    """
+    Reads an intermediate DataFrame written by write_frame, loading only the requested columns.
+    Feather files are memory-mapped, so columns are read without parsing any text.
+
+    Parameters:
+    - directory (str): The directory holding the file.
+    - name (str): The file name without extension.
+    - columns (list): The columns to load, in order. Defaults to all columns.
+    - fmt (str): 'feather' or 'csv'.
+
+    Returns:
+    - pd.DataFrame: The loaded DataFrame.
+    """
+
+    if fmt == "feather":
+        from pyarrow import feather
+        table = feather.read_table(os.path.join(directory, f"{name}.feather"), columns=columns, memory_map=True)
+        return table.to_pandas()
+
+    import pandas as pd
+    df = pd.read_csv(os.path.join(directory, f"{name}.csv"), usecols=columns)
+    return df if columns is None else df[columns]
@@ -0,0 +1,230 @@
+import os
+import numpy as np
+import pandas as pd
+from typing import Tuple
+from compact_schema import uuid_to_pair
+from helper_utils import get_run_logger
+from config import (known_ids_path, use_known_ids)
+
+
+# Persistent local index of the customerIds and transactionIds already loaded into the database, so the
+# loaders can drop known rows in memory instead of shipping them to Postgres to be skipped there.
+# Each index is a sorted array of 128-bit UUIDs (16 big-endian bytes, so byte order is numeric order) in
+# <known_ids_path>/<name>.npy, memory-mapped on load and searched with np.searchsorted.
+# The index only ever holds IDs whose load was committed, so a hit is always an ID that exists in the
+# database (unless rows were deleted there: see rebuild and verify). A miss is not trusted: those rows
+# still go through the loader's anti-join, which is the exact fallback.
+
+# name -> (table, key column, DataFrame column)
+INDEXED_TABLES = {
+    "customers": ("customers", "CUSTOMER_ID", "customerId"),
+    "transactions": ("TRANSACTIONS", "TRANSACTION_ID", "transactionId"),
+}
+
+KEY_DTYPE = "S16"
+# Lowercase only: an uppercase ID is a different string to Postgres, so it must not share a key with its lowercase form.
+UUID_PATTERN = r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}"
+FETCH_ROWS = 100000
+
+indexes = {}
+
+
+def to_keys(ids: pd.Series) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Converts UUID strings to 16-byte sortable keys.
+
+    Returns:
+    - np.ndarray: The keys of the canonical UUIDs, in order.
+    - np.ndarray: A boolean array, True where the value was a canonical UUID (others have no key).
+    """
+
+    ids = pd.Series(ids, dtype=object)
+    canonical = ids.str.fullmatch(UUID_PATTERN).fillna(False).to_numpy(dtype=bool)
+
+    if not canonical.any():
+        return np.empty(0, dtype=KEY_DTYPE), canonical
+
+    hi, lo = uuid_to_pair(ids[canonical])
+    halves = np.empty((hi.shape[0], 2), dtype=">u8")
+    halves[:, 0], halves[:, 1] = hi, lo
+
+    return halves.view(KEY_DTYPE).ravel(), canonical
+
+
+class KnownIdIndex():
+    """
+    Sorted, de-duplicated array of the IDs loaded into one table. IDs of a load are staged while its
+    transaction is open and only written to disk by commit, once the database has committed.
+    """
+
+    def __init__(self, path, name) -> None:
+
+        self.name = name
+        self.file_w_path = os.path.join(path, f"{name}.npy")
+        self.keys = None
+        self.pending = []
+
+    def load(self):
+
+        if self.keys is None:
+            if os.path.exists(self.file_w_path):
+                self.keys = np.load(self.file_w_path, mmap_mode="r")
+            else:
+                self.keys = np.empty(0, dtype=KEY_DTYPE)
+
+        return self.keys
+
+    def contains(self, ids: pd.Series) -> np.ndarray:
+        """
+        Returns a boolean array, True where the ID is in the index. Non-canonical IDs are never found.
+        """
+
+        keys = self.load()
+        found = np.zeros(len(ids), dtype=bool)
+
+        if keys.shape[0] == 0 or len(ids) == 0:
+            return found
+
+        wanted, canonical = to_keys(ids)
+
+        positions = np.searchsorted(keys, wanted)
+        positions[positions == keys.shape[0]] = 0
+        found[canonical] = keys[positions] == wanted
+
+        return found
+
+    def stage(self, ids: pd.Series):
+        """
+        Remembers the IDs of a load in progress; they are added to the index by commit.
+        """
+
+        self.pending.append(to_keys(ids)[0])
+
+    def discard(self):
+
+        self.pending = []
+
+    def commit(self):
+        """
+        Merges the staged IDs into the index and writes it atomically.
+        """
+
+        if not self.pending:
+            return
+
+        self.write(np.unique(np.concatenate([np.asarray(self.load())] + self.pending)))
+        self.pending = []
+
+    def write(self, keys: np.ndarray):
+
+        os.makedirs(os.path.dirname(self.file_w_path), exist_ok=True)
+        tmp_w_path = self.file_w_path + ".tmp"
+
+        with open(tmp_w_path, 'wb') as f:
+            np.save(f, keys.astype(KEY_DTYPE))
+        os.replace(tmp_w_path, self.file_w_path)
+
+        self.keys = None
+
+    def database_keys(self, conn) -> np.ndarray:
+        """
+        Reads every ID of the indexed table, streamed through a server-side cursor.
+        """
+
+        table, key_column, _ = INDEXED_TABLES[self.name]
+        batches = []
+
+        with conn.cursor(name=f"known_ids_{self.name}") as cur:
+
+            cur.itersize = FETCH_ROWS
+            cur.execute(f"SELECT {key_column} FROM {table}")
+
+            while True:
+                rows = cur.fetchmany(FETCH_ROWS)
+                if not rows:
+                    break
+                batches.append(to_keys(pd.Series([row[0] for row in rows], dtype=object))[0])
+
+        conn.rollback()
+
+        return np.unique(np.concatenate(batches)) if batches else np.empty(0, dtype=KEY_DTYPE)
+
+    def rebuild(self, conn) -> int:
+        """
+        Replaces the index with the IDs currently in the database. Returns the number of IDs.
+        """
+
+        keys = self.database_keys(conn)
+        self.write(keys)
+        self.pending = []
+
+        return keys.shape[0]
+
+    def verify(self, conn) -> dict:
+        """
+        Compares the index with the database.
+
+        Returns:
+        - dict: indexed and database ID counts, "stale" IDs in the index but no longer in the database
+          (these rows would wrongly be skipped: rebuild), and "missing" IDs in the database but not in
+          the index (harmless: they are caught by the anti-join).
+        """
+
+        keys = np.asarray(self.load())
+        database_keys = self.database_keys(conn)
+
+        return {"index": self.name, "indexed": int(keys.shape[0]), "in_database": int(database_keys.shape[0]),
+                "stale": int((~np.isin(keys, database_keys)).sum()),
+                "missing": int((~np.isin(database_keys, keys)).sum())}
+
+
+def get_known_id_index(name) -> KnownIdIndex:
+    """
+    Returns the process wide index of the given name (see INDEXED_TABLES).
+    """
+
+    if name not in indexes:
+        indexes[name] = KnownIdIndex(known_ids_path, name)
+
+    return indexes[name]
+
+
+def drop_known_rows(df: pd.DataFrame, name: str) -> pd.DataFrame:
+    """
+    Removes the rows whose ID is in the known-ID index and stages the IDs of the remaining rows,
+    which are about to be loaded. Does nothing when use_known_ids is off.
+    """
+
+    if not use_known_ids:
+        return df
+
+    index = get_known_id_index(name)
+    column = INDEXED_TABLES[name][2]
+
+    known = index.contains(df[column])
+    if known.any():
+        get_run_logger().info(f"{name}: {int(known.sum())} rows already loaded according to the known-ID index, not sent.",
+                              index=name, rows_known=int(known.sum()))
+        df = df[~known]
+
+    index.stage(df[column])
+
+    return df
+
+
+def commit_known_ids():
+    """
+    Adds the IDs staged by every index to its file. Call once the database transaction has committed.
+    """
+
+    for index in indexes.values():
+        index.commit()
+
+
+def discard_known_ids():
+    """
+    Forgets the IDs staged by every index, e.g. after the database transaction was rolled back.
+    """
+
+    for index in indexes.values():
+        index.discard()
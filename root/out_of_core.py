@@ -0,0 +1,107 @@
+import os
+import math
+import shutil
+import numpy as np
+import pandas as pd
+from compact_schema import (transaction_hash, concat_frames)
+from helper_utils import raw_file_size
+from config import (spill_path, memory_budget_mb)
+
+
+# Out-of-core mode (out_of_core in config.py): instead of keeping every chunk's valid rows in memory until
+# the cross-chunk duplicate check, each chunk is spilled to disk split into partitions by a hash of its
+# transactionId. Every row of a transactionId ends up in the same partition, so the partitions can be
+# deduplicated one at a time, each within memory_budget_mb.
+# The budget only covers validation and deduplication: restore_order joins the kept rows of every partition
+# into one frame, which is then converted back to the regular schema and handed to the loaders whole, so peak
+# memory still grows with the number of valid rows in the file.
+# The same partitions are validated concurrently by the parallel mode (validation_workers in config.py).
+
+ROW_COLUMN = "_row"
+
+
+def partitions_for_budget(files_w_path, budget_mb = memory_budget_mb):
+    """
+    Returns the number of partitions needed for a day's raw files so that one partition fits the memory budget.
+    The raw JSON text takes more space than the parsed rows, so its (uncompressed) size is used as an upper bound.
+    """
+
+    return max(1, math.ceil(sum(raw_file_size(file_w_path) for file_w_path in files_w_path) / (budget_mb * 2**20)))
+
+
+class SpillPartitions():
+    """
+    Spills DataFrames to uncompressed Arrow files, one per partition and chunk, under
+    <spill_path>/<file>/. Each row is tagged with its position in the concatenation of all spilled
+    chunks, so the original order can be restored after the partitions are processed.
+    """
+
+    def __init__(self, latest_filename, partitions, path = spill_path) -> None:
+
+        self.partitions = partitions
+        self.directory = os.path.join(path, latest_filename.replace(".json", ""))
+        self.chunks = 0
+        self.rows = 0
+
+        # Leftovers of an interrupted run are not reused.
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory)
+
+    def partition_file(self, partition, chunk):
+
+        return os.path.join(self.directory, f"part_{partition:05d}_{chunk:06d}.feather")
+
+    def spill(self, df: pd.DataFrame):
+        """
+        Writes one chunk, split into partitions.
+        """
+
+        from pyarrow import feather
+
+        df = df.reset_index(drop=True)
+        df[ROW_COLUMN] = np.arange(self.rows, self.rows + df.shape[0], dtype=np.int64)
+
+        partition_of_row = transaction_hash(df) % np.uint64(self.partitions)
+
+        for partition in range(self.partitions):
+
+            part = df[partition_of_row == partition]
+            if part.shape[0] > 0:
+                feather.write_feather(part.reset_index(drop=True), self.partition_file(partition, self.chunks), compression="uncompressed")
+
+        self.chunks += 1
+        self.rows += df.shape[0]
+
+    def read_partition(self, partition) -> pd.DataFrame:
+        """
+        Reads back every chunk of one partition, in spill order.
+        """
+
+        from pyarrow import feather
+
+        frames = [feather.read_feather(self.partition_file(partition, chunk), memory_map=True)
+                  for chunk in range(self.chunks) if os.path.exists(self.partition_file(partition, chunk))]
+
+        return concat_frames(frames)
+
+    def result_file(self, partition, name):
+
+        return os.path.join(self.directory, f"{name}_{partition:05d}.feather")
+
+    def cleanup(self):
+
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+def restore_order(frames) -> pd.DataFrame:
+    """
+    Concatenates frames read from partitions and puts their rows back in spill order, dropping the row tag.
+    """
+
+    df = concat_frames([frame for frame in frames if frame.shape[0] > 0] or frames[:1])
+    if ROW_COLUMN not in df.columns:
+        return df
+
+    df = df.sort_values(ROW_COLUMN, kind="stable").drop(columns=ROW_COLUMN)
+
+    return df.reset_index(drop=True)
@@ -1,16 +1,250 @@
-import data_validation
-import data_to_postgredb
-from helper_utils import get_latest_filename
+import argparse
+import signal
+from collections import deque
+from itertools import islice
+from concurrent.futures import ProcessPoolExecutor
+from db_connection import (db_transaction, close_connection_pool)
+from stage_metrics import StageMetrics
+from run_manifest import (get_file_hash, first_incomplete_stage, record_stage, validation_artifacts)
+from helper_utils import (get_latest_filename, get_file_date, get_unprocessed_filenames, mark_file_processed,
+                          LoggerClass, set_run_logger, get_run_logger)
 from config import *
 
+# data_validation and data_to_postgredb (and with them pandas and psycopg2) are imported
+# inside the functions that need them, so importing this module or running --help is cheap.
 
-latest_file = (get_latest_filename(raw_data_path, date_fmt))
-latest_file_date = latest_file.replace(".json", "").split("_")[1:]
-latest_file_date = "_".join(latest_file_date)
-# print(latest_file_date)
 
+def load_file(file, customers_df = None, transactions_df = None):
+    """
+    Loads the validated customers and transactions of one raw file, committed together
+    over one pooled connection, and records the file in the processed-files manifest.
+    DataFrames handed over in memory are loaded directly; otherwise they are read from final_data.
+    """
 
+    import data_to_postgredb, known_ids, transaction_state
 
-data_validation.run_all()
-data_to_postgredb.customer_SQLtable_update(latest_file_date)
-data_to_postgredb.transaction_SQLtable_update(latest_file_date)
\ No newline at end of file
+    file_date = get_file_date(file)
+
+    # Loading is logged after the validation records, in the same log and metrics files.
+    logger = LoggerClass(path = "logs", latest_filename = file, overwrite = False)
+    metrics = StageMetrics(path = "logs", latest_filename = file, overwrite = False)
+    set_run_logger(logger)
+
+    try:
+        try:
+            with db_transaction() as conn:
+
+                with metrics.stage("load_customers", rows_in = None if customers_df is None else customers_df.shape[0]) as stage:
+                    stage["rows_out"] = data_to_postgredb.customer_SQLtable_update(file_date, conn, customers_df)
+
+                with metrics.stage("load_transactions", rows_in = None if transactions_df is None else transactions_df.shape[0]) as stage:
+                    stage["rows_out"] = data_to_postgredb.transaction_SQLtable_update(file_date, conn, transactions_df)
+
+        except Exception:
+            known_ids.discard_known_ids()
+            transaction_state.discard_transaction_state()
+            raise
+
+        # Only IDs the database has committed go into the known-ID index and the transaction state.
+        known_ids.commit_known_ids()
+        transaction_state.commit_transaction_state()
+        mark_file_processed(processed_manifest_path, file)
+
+    finally:
+        metrics.write()
+        logger.close()
+        set_run_logger(None)
+
+
+def record_validation(file, file_hash):
+    """
+    Records the validation stage of a file in the run manifest. Only done when the final_data files
+    the load stage can resume from are written.
+    """
+
+    if write_final_data:
+        record_stage(file_hash, file, "validation", validation_artifacts(file))
+
+
+def load_and_record(file, file_hash, customers_df = None, transactions_df = None):
+
+    load_file(file, customers_df, transactions_df)
+    record_stage(file_hash, file, "load")
+
+
+def run_pipeline(file):
+    """
+    Validates one raw file and loads it, handing the validated DataFrames to the loader in memory.
+    The run manifest is checked first: a file whose content was already loaded is skipped, and one whose
+    validation completed in an earlier (failed) run is loaded from its final_data files.
+    """
+
+    import data_validation
+
+    file_hash = get_file_hash(raw_data_path, file)
+    stage = first_incomplete_stage(file_hash)
+
+    if stage is None:
+        mark_file_processed(processed_manifest_path, file)
+        get_run_logger().info(f"{file} is unchanged and already loaded; skipping.", sha256=file_hash)
+        return
+
+    if stage == "load":
+        get_run_logger().info(f"{file} was validated by an earlier run; resuming from the load.", sha256=file_hash)
+        load_and_record(file, file_hash)
+        return
+
+    customers_df, transactions_df = data_validation.run_all(file)
+    record_validation(file, file_hash)
+    load_and_record(file, file_hash, customers_df, transactions_df)
+
+
+def catch_up():
+    """
+    Processes every raw file missing from the processed-files manifest.
+    Files are validated concurrently in a process pool but loaded strictly in date order,
+    so later files are always applied after earlier ones. As in run_pipeline, files the run manifest
+    shows as loaded are skipped and files already validated are loaded from final_data.
+    """
+
+    files = get_unprocessed_filenames(raw_data_path, processed_manifest_path)
+    get_run_logger().info(f"Catch-up: {len(files)} unprocessed file(s).", files=len(files))
+
+    if not files:
+        return
+
+    import data_validation
+
+    file_hashes = {file: get_file_hash(raw_data_path, file) for file in files}
+    stages = {file: first_incomplete_stage(file_hashes[file]) for file in files}
+    to_validate = [file for file in files if stages[file] == "validation"]
+
+    workers = catch_up_workers or 1
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+
+        # Files are submitted in date order, at most workers ahead of the load: the next file is only submitted
+        # once one is loaded, so validated DataFrames waiting for their turn never pile up in this process.
+        # Each file is loaded as soon as it and every earlier file have been validated.
+        pending = iter(to_validate)
+        validating = deque(executor.submit(data_validation.run_all, file) for file in islice(pending, workers))
+
+        for file in files:
+
+            if stages[file] is None:
+                mark_file_processed(processed_manifest_path, file)
+                get_run_logger().info(f"Catch-up: {file} is unchanged and already loaded; skipped.")
+                continue
+
+            if stages[file] == "validation":
+                customers_df, transactions_df = validating.popleft().result()
+                record_validation(file, file_hashes[file])
+                load_and_record(file, file_hashes[file], customers_df, transactions_df)
+                del customers_df, transactions_df
+
+                for next_file in islice(pending, 1):
+                    validating.append(executor.submit(data_validation.run_all, next_file))
+            else:
+                load_and_record(file, file_hashes[file])
+
+            get_run_logger().info(f"Catch-up: loaded {file}.")
+
+
+def watch():
+    """
+    Runs until interrupted, processing each raw file with run_pipeline as it lands in raw_data_path
+    (see file_watcher.py). Files are processed one at a time in this process, so the imports, the
+    connection pool and the known-ID indexes stay warm between files. A file that fails is logged and
+    retried once it changes; the watch carries on with the next one.
+    """
+
+    # Everything the first file would otherwise pay for is set up before watching.
+    import data_validation, data_to_postgredb, known_ids, transaction_state
+    from db_connection import get_connection_pool
+    from file_watcher import RawFileWatcher
+
+    get_connection_pool()
+    for name in known_ids.INDEXED_TABLES:
+        known_ids.get_known_id_index(name).load()
+    transaction_state.get_transaction_state().load()
+
+    watcher = RawFileWatcher()
+
+    # SIGTERM (e.g. from a service manager) stops the watch like Ctrl+C, after the file in progress.
+    signal.signal(signal.SIGTERM, lambda signum, frame: watcher.stop_event.set())
+
+    watcher.start()
+    get_run_logger().info(f"Watching {raw_data_path} every {watch_poll_seconds}s (queue of {watch_queue_size}).")
+
+    try:
+        while not watcher.stop_event.is_set():
+
+            file = watcher.next_file()
+            if file is None:
+                continue
+
+            try:
+                run_pipeline(file)
+                get_run_logger().info(f"Watch: processed {file}.")
+                watcher.done(file)
+
+            except Exception as error:
+                get_run_logger().error("Watch: %s failed: %s - retried once the file changes." % (file, error))
+                watcher.done(file, failed = True)
+
+    except KeyboardInterrupt:
+        pass
+
+    finally:
+        watcher.stop()
+        get_run_logger().info("Watch stopped.")
+
+
+def check_known_ids(rebuild):
+    """
+    Rebuilds the known-ID indexes from the database, or verifies them against it.
+    """
+
+    import known_ids
+
+    with db_transaction() as conn:
+        for name in known_ids.INDEXED_TABLES:
+
+            index = known_ids.get_known_id_index(name)
+
+            if rebuild:
+                get_run_logger().info(f"Rebuilt the {name} known-ID index: {index.rebuild(conn)} IDs.")
+            else:
+                report = index.verify(conn)
+                level = "WARNING" if report["stale"] else "INFO"
+                get_run_logger().log(level, f"{name} known-ID index: {report['indexed']} IDs indexed, "
+                                     f"{report['in_database']} in the database, {report['stale']} stale "
+                                     f"(rebuild if not 0), {report['missing']} missing.", **report)
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Validate the raw transactions files and load them into Postgres.")
+    parser.add_argument("--catch-up", action="store_true",
+                        help="process every raw file not yet in the processed-files manifest, instead of only the latest one")
+    parser.add_argument("--watch", action="store_true",
+                        help="keep running and process each new raw file as it lands in raw_data_path")
+    parser.add_argument("--rebuild-known-ids", action="store_true", help="rebuild the known-ID indexes from the database")
+    parser.add_argument("--verify-known-ids", action="store_true", help="compare the known-ID indexes with the database")
+    args = parser.parse_args()
+
+    try:
+        if args.rebuild_known_ids or args.verify_known_ids:
+            check_known_ids(rebuild = args.rebuild_known_ids)
+        elif args.watch:
+            watch()
+        elif args.catch_up:
+            catch_up()
+        else:
+            run_pipeline(get_latest_filename(raw_data_path, date_fmt))
+    finally:
+        close_connection_pool()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+import os
+import json
+import hashlib
+from datetime import datetime
+from helper_utils import raw_parts
+from config import (run_manifest_path, final_data_path, intermediate_format)
+
+
+# Run manifest: records, per raw file content (sha256), which pipeline stages have completed and the
+# artifacts they left behind, so an unchanged file that was already loaded is skipped and a failed run
+# resumes from its first incomplete stage instead of re-reading and re-validating the raw file.
+#
+#   {"files": {name: {"sha256", "size", "mtime_ns", "parts"}},
+#    "runs":  {sha256: {"file": name, "stages": {stage: {"completed": time, "artifacts": {name: path}}}}}}
+#
+# name is a day file name (see helper_utils.raw_parts); its hash covers the bytes of all of the day's files, as stored.
+# "files" caches each day's hash by the size and modification time of its files, so unchanged days are not re-hashed.
+
+STAGES = ["validation", "load"]
+HASH_READ_SIZE = 1 << 20
+
+
+def load_run_manifest(manifest_path = run_manifest_path):
+
+    if not os.path.exists(manifest_path):
+        return {"files": {}, "runs": {}}
+
+    with open(manifest_path, 'r') as f:
+        return json.load(f)
+
+
+def save_run_manifest(manifest, manifest_path = run_manifest_path):
+    """
+    Rewrites the manifest atomically so an interrupted run cannot corrupt it.
+    """
+
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=4, sort_keys=True)
+    os.replace(tmp_path, manifest_path)
+
+
+def get_file_hash(path, file, manifest_path = run_manifest_path):
+    """
+    Returns the sha256 of a raw day's content: the bytes of its files (parts, compressed or not) in part order.
+    The hash is cached in the manifest and only recomputed when the files, their sizes or modification times changed.
+    """
+
+    parts = raw_parts(path, file)
+    if not parts:
+        raise FileNotFoundError(f"File not found: {os.path.join(path, file)}")
+
+    stats = [os.stat(os.path.join(path, part)) for part in parts]
+    size, mtime_ns = sum(stat.st_size for stat in stats), max(stat.st_mtime_ns for stat in stats)
+
+    manifest = load_run_manifest(manifest_path)
+    cached = manifest["files"].get(file)
+
+    if (cached is not None and cached["size"] == size and cached["mtime_ns"] == mtime_ns
+            and cached.get("parts", [file]) == parts):
+        return cached["sha256"]
+
+    sha256 = hashlib.sha256()
+    for part in parts:
+        with open(os.path.join(path, part), 'rb') as f:
+            for block in iter(lambda: f.read(HASH_READ_SIZE), b""):
+                sha256.update(block)
+
+    manifest["files"][file] = {"sha256": sha256.hexdigest(), "size": size, "mtime_ns": mtime_ns, "parts": parts}
+    save_run_manifest(manifest, manifest_path)
+
+    return sha256.hexdigest()
+
+
+def validation_artifacts(file):
+    """
+    Returns the final_data files a validation stage leaves for the load stage, by name.
+    """
+
+    filename_without_ext = file.replace(".json", "")
+    ext = "csv" if intermediate_format == "csv" else "feather"
+
+    return {"customers": os.path.join(final_data_path, f"customers_only_{filename_without_ext}.{ext}"),
+            "transactions": os.path.join(final_data_path, f"transactions_only_{filename_without_ext}.{ext}")}
+
+
+def record_stage(file_hash, file, stage, artifacts = None, manifest_path = run_manifest_path):
+    """
+    Records a stage as completed for the given file content.
+    """
+
+    manifest = load_run_manifest(manifest_path)
+    run = manifest["runs"].setdefault(file_hash, {"file": file, "stages": {}})
+    run["file"] = file
+    run["stages"][stage] = {"completed": datetime.now().isoformat(timespec="seconds"), "artifacts": artifacts or {}}
+
+    save_run_manifest(manifest, manifest_path)
+
+
+def first_incomplete_stage(file_hash, manifest_path = run_manifest_path):
+    """
+    Returns the stage (see STAGES) a run of the given file content should start from: the one after the
+    last completed stage whose artifacts still exist, or None if the file was fully loaded.
+    """
+
+    stages = load_run_manifest(manifest_path)["runs"].get(file_hash, {"stages": {}})["stages"]
+
+    for position in range(len(STAGES) - 1, -1, -1):
+
+        completed = stages.get(STAGES[position])
+        if completed is not None and all(os.path.exists(path) for path in completed["artifacts"].values()):
+            return STAGES[position + 1] if position + 1 < len(STAGES) else None
+
+    return STAGES[0]
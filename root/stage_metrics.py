@@ -0,0 +1,153 @@
+import os, json, time, cProfile, tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+from config import (metrics_trace_memory, metrics_profile_stage)
+
+# resource (peak RSS) only exists on Unix; elsewhere peak RSS is not reported.
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+def peak_rss_mb():
+    """
+    Returns the peak resident set size of this process so far in MB, or None if unavailable.
+    """
+
+    if resource is None:
+        return None
+
+    # ru_maxrss is in kilobytes on Linux.
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+class StageMetrics():
+    """
+    Collects per-stage wall time, rows in/out, rows/sec and memory for one run, and writes them as
+    JSON lines to metrics_<file>.jsonl next to the run's log. A stage may be entered many times
+    (e.g. once per chunk); its figures are summed over all calls.
+
+    When metrics_trace_memory is set, the peak Python allocation of each stage is measured with tracemalloc
+    (which slows the run down). When metrics_profile_stage names a stage, that stage is run under cProfile
+    and the profile is dumped to profile_<stage>_<file>.prof.
+    Without a path, nothing is written and the figures are only kept in stages.
+    """
+
+    def __init__(self, path, latest_filename, overwrite = True, trace_memory = metrics_trace_memory, profile_stage = metrics_profile_stage) -> None:
+
+        self.path = path
+        self.latest_filename = latest_filename
+        self.trace_memory = trace_memory
+        self.profile_stage = profile_stage
+        self.profiler = cProfile.Profile() if profile_stage else None
+        self.stages = {}
+        self.file_w_path = None
+
+        if path is not None:
+
+            filename_without_ext = latest_filename.replace(".json", "")
+            self.file_w_path = os.path.join(path, f"metrics_{filename_without_ext}.jsonl")
+            self.profile_w_path = os.path.join(path, f"profile_{profile_stage}_{filename_without_ext}.prof")
+
+            if overwrite and os.path.exists(self.file_w_path):
+                os.remove(self.file_w_path)
+
+    @contextmanager
+    def stage(self, name, rows_in = None):
+        """
+        Measures the enclosed block as one call of stage name. The block may set "rows_in"/"rows_out"
+        on the yielded dict once they are known.
+        """
+
+        current = {"rows_in": rows_in, "rows_out": None}
+
+        if self.trace_memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            tracemalloc.reset_peak()
+
+        profile = self.profiler is not None and name == self.profile_stage
+        if profile:
+            self.profiler.enable()
+
+        start = time.perf_counter()
+
+        try:
+            yield current
+
+        finally:
+
+            elapsed = time.perf_counter() - start
+
+            if profile:
+                self.profiler.disable()
+
+            totals = self.stages.setdefault(name, {"stage": name, "calls": 0, "seconds": 0.0, "rows_in": None,
+                                                   "rows_out": None, "peak_traced_mb": None, "peak_rss_mb": None})
+            totals["calls"] += 1
+            totals["seconds"] += elapsed
+
+            for key in ("rows_in", "rows_out"):
+                if current[key] is not None:
+                    totals[key] = (totals[key] or 0) + int(current[key])
+
+            if self.trace_memory:
+                peak_traced_mb = round(tracemalloc.get_traced_memory()[1] / 2**20, 1)
+                totals["peak_traced_mb"] = max(totals["peak_traced_mb"] or 0, peak_traced_mb)
+
+            totals["peak_rss_mb"] = peak_rss_mb()
+
+    def timed_iter(self, name, iterable):
+        """
+        Yields the items of iterable, measuring the time spent producing each one as a call of stage name.
+        Each item's len() is counted as rows out.
+        """
+
+        iterator = iter(iterable)
+
+        while True:
+
+            with self.stage(name) as current:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+                current["rows_out"] = len(item)
+
+            yield item
+
+    def summary(self):
+        """
+        Returns one record per stage, in the order the stages were first entered, with rows/sec
+        (rows in, or rows out for stages that only produce rows) added.
+        """
+
+        records = []
+
+        for totals in self.stages.values():
+
+            record = dict(totals)
+            record["seconds"] = round(record["seconds"], 4)
+            rows = record["rows_in"] if record["rows_in"] is not None else record["rows_out"]
+            record["rows_per_sec"] = None if rows is None else round(rows / max(totals["seconds"], 1e-9))
+            records.append(record)
+
+        return records
+
+    def write(self):
+        """
+        Appends the stage records to the metrics file and dumps the profile, if any.
+        """
+
+        if self.file_w_path is None:
+            return
+
+        run_time = datetime.now().isoformat(timespec="seconds")
+
+        with open(self.file_w_path, 'a') as f:
+            for record in self.summary():
+                f.write(json.dumps({"time": run_time, "file": self.latest_filename, **record}) + "\n")
+
+        if self.profiler is not None and self.profile_stage in self.stages:
+            self.profiler.dump_stats(self.profile_w_path)
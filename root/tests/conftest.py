@@ -0,0 +1,5 @@
+import os
+import sys
+
+# The pipeline modules are flat modules in root/, imported by name.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,104 @@
+import json
+import os
+import pandas as pd
+import pytest
+import data_validation
+from compact_schema import (to_compact_schema, from_compact_schema)
+from generate_data import generate_file
+from helper_utils import LoggerClass
+from config import (allowed_currency, date_fmt)
+
+
+FILE = "transactions_2024_02_01.json"
+ROWS = 2000
+CHUNK_ROWS = 500
+ODD_ROW = 1600
+
+ODD_VALUES = {
+    "non-uuid transactionId": ("transactionId", "not-a-uuid"),
+    "uppercase transactionId": ("transactionId", "FBBE0690-0CD1-48EB-AECE-F2744DB6F895"),
+    "uppercase customerId": ("customerId", "FBBE0690-0CD1-48EB-AECE-F2744DB6F895"),
+    "3-decimal amount": ("amount", "12.345"),
+    "1-decimal amount": ("amount", "12.5"),
+    "space separated sourceDate": ("sourceDate", "2021-04-26 00:17:33"),
+}
+
+
+@pytest.fixture
+def raw_file(tmp_path, monkeypatch, request):
+    """
+    Writes a synthetic raw file with one odd value in a late chunk, and runs the test from tmp_path so the
+    spill and raw index files stay there.
+    """
+
+    monkeypatch.chdir(tmp_path)
+    raw_data_path = os.path.join(tmp_path, "raw_data")
+    os.makedirs(raw_data_path)
+
+    file_w_path = generate_file(raw_data_path, FILE, ROWS)
+    column, value = ODD_VALUES[request.param]
+
+    with open(file_w_path) as f:
+        data = json.load(f)
+    data["transactions"][ODD_ROW][column] = value
+    with open(file_w_path, "w") as f:
+        json.dump(data, f)
+
+    return raw_data_path, column, value
+
+
+def validate(tmp_path, raw_data_path, monkeypatch, compact, mode):
+
+    monkeypatch.setattr(data_validation, "chunk_size", CHUNK_ROWS)
+    monkeypatch.setattr(data_validation, "compact_schema", compact)
+    monkeypatch.setattr(data_validation, "out_of_core", mode == "out_of_core")
+    monkeypatch.setattr(data_validation, "validation_workers", 2 if mode == "parallel" else 1)
+    monkeypatch.setattr(data_validation, "partitions_for_budget", lambda files_w_path: 4)
+    monkeypatch.setattr(data_validation, "Logger", LoggerClass(path = None, latest_filename = FILE, level = "ERROR"))
+
+    output_path = os.path.join(tmp_path, f"out_{compact}_{mode}")
+    os.makedirs(output_path)
+
+    df_v = data_validation.run_all_validation_checks(allowed_currency, FILE, date_fmt, output_path, output_path,
+                                                     write_output = False, raw_data_path = raw_data_path)
+    df_i = pd.read_csv(os.path.join(output_path, f"removed_rows_{FILE.replace('.json', '')}.csv"), dtype=str)
+
+    return df_v, df_i
+
+
+@pytest.mark.parametrize("raw_file", list(ODD_VALUES), indirect=True)
+@pytest.mark.parametrize("mode", ["in_memory", "out_of_core", "parallel"])
+def test_late_chunk_outside_compact_layout(tmp_path, monkeypatch, raw_file, mode):
+    """
+    A value the first chunk's compact layout cannot hold, after the first chunk, gives the same output as the
+    regular schema, with the value unchanged.
+    """
+
+    raw_data_path, column, value = raw_file
+
+    df_v, df_i = validate(tmp_path, raw_data_path, monkeypatch, compact = True, mode = mode)
+    expected_v, expected_i = validate(tmp_path, raw_data_path, monkeypatch, compact = False, mode = mode)
+
+    pd.testing.assert_frame_equal(df_v, expected_v)
+    pd.testing.assert_frame_equal(df_i, expected_i)
+
+    assert (df_v[column].astype(str) == value).any() or (df_i[column].astype(str) == value).any()
+
+
+def test_uuid_round_trip_is_exact():
+    """
+    Only UUIDs converted back byte for byte are compacted.
+    """
+
+    df = pd.DataFrame({"transactionId": ["7b3c8eee-3689-4cf8-b874-dfbe515d2eb7", "FBBE0690-0CD1-48EB-AECE-F2744DB6F895"]})
+
+    df_compact, layout = to_compact_schema(df)
+    assert "transactionId" not in layout
+    pd.testing.assert_frame_equal(from_compact_schema(df_compact), df)
+
+    df_compact, layout = to_compact_schema(df.iloc[:1])
+    assert layout == {"transactionId"}
+    pd.testing.assert_frame_equal(from_compact_schema(df_compact), df.iloc[:1])
+
+    df_compact, _ = to_compact_schema(df.iloc[1:], layout)
+    assert df_compact is None
@@ -0,0 +1,240 @@
+import os
+import numpy as np
+import pandas as pd
+from typing import Tuple
+from known_ids import to_keys
+from date_parsing import parse_dates
+from helper_utils import get_run_logger
+from config import (transaction_state_path, use_transaction_state, date_fmt)
+
+
+# Persistent per-transaction state of what has been loaded, so incoming rows can be told apart in memory:
+#  - new: transactionId never loaded (or not a canonical UUID, which the state cannot hold),
+#  - amended: loaded before, but this row has a later sourceDate and different content,
+#  - unchanged: loaded before with the same content, or with a sourceDate at least as recent.
+# Only new rows are inserted and only amended rows updated; unchanged rows are not sent to Postgres.
+#
+# The state is one sorted structured array in <transaction_state_path>/transactions.npy: the transactionId
+# as a 16-byte key (see known_ids.to_keys), the latest sourceDate, the TRANSACTION_DATE the row was loaded
+# with (so an update goes straight to its partition) and a hash of the loaded columns.
+# Like the known-ID index, rows are staged while the load's transaction is open and only written by commit.
+# Transactions loaded before the state existed are not in it: they count as new, and are skipped by the
+# loader as before (see data_to_postgredb.claim_transaction_ids); amendments of them are recognised from their next load on.
+
+STATE_DTYPE = np.dtype([("key", "S16"), ("source_date", "<i8"), ("transaction_date", "<i4"), ("row_hash", "<u8")])
+
+NEW, AMENDED, UNCHANGED = 0, 1, 2
+PREVIOUS_DATE_COLUMN = "previousTransactionDate"
+
+states = {}
+
+
+def row_hashes(df: pd.DataFrame) -> np.ndarray:
+    """
+    Returns a uint64 hash of the loaded columns of each row, the same whether the frame was handed over in
+    memory or read back from final_data (categorical or object strings, parsed or string dates).
+    """
+
+    normalised = pd.DataFrame({
+        "customerId": df["customerId"].to_numpy(dtype=object),
+        "transactionDate": parse_dates(df["transactionDate"], date_fmt).to_numpy(dtype="datetime64[ns]").astype("datetime64[D]").view("int64"),
+        "currency": df["currency"].to_numpy(dtype=object),
+        "amount": np.round(pd.to_numeric(df["amount"]).to_numpy(dtype="float64"), 4),
+    })
+
+    return pd.util.hash_pandas_object(normalised, index=False).to_numpy()
+
+
+def state_rows(df: pd.DataFrame) -> np.ndarray:
+    """
+    Builds the state of the rows of a frame with canonical transactionIds, sorted by key.
+    """
+
+    keys, canonical = to_keys(df["transactionId"])
+
+    rows = np.empty(keys.shape[0], dtype=STATE_DTYPE)
+    rows["key"] = keys
+    rows["source_date"] = parse_dates(df["sourceDate"]).to_numpy(dtype="datetime64[ns]")[canonical].view("int64")
+    rows["transaction_date"] = parse_dates(df["transactionDate"], date_fmt).to_numpy(dtype="datetime64[ns]")[canonical].astype("datetime64[D]").view("int64")
+    rows["row_hash"] = row_hashes(df)[canonical]
+
+    return rows[np.argsort(rows["key"], kind="stable")]
+
+
+class TransactionState():
+    """
+    Sorted array of the state of every transaction loaded. Only the key column is searched, through a
+    contiguous copy made on load and kept up to date by write, so in watch mode later files do not copy it again.
+    """
+
+    def __init__(self, path, name = "transactions") -> None:
+
+        self.file_w_path = os.path.join(path, f"{name}.npy")
+        self.rows = None
+        self.keys = None
+        self.pending = []
+
+    def load(self):
+
+        if self.rows is None:
+            if os.path.exists(self.file_w_path):
+                self.rows = np.load(self.file_w_path, mmap_mode="r")
+            else:
+                self.rows = np.empty(0, dtype=STATE_DTYPE)
+            self.keys = np.ascontiguousarray(self.rows["key"])
+
+        return self.rows
+
+    def lookup(self, keys: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Returns, for each key, whether it is in the state and its position there.
+        """
+
+        rows = self.load()
+        if rows.shape[0] == 0:
+            return np.zeros(keys.shape[0], dtype=bool), np.zeros(keys.shape[0], dtype=np.int64)
+
+        positions = np.searchsorted(self.keys, keys)
+        positions[positions == rows.shape[0]] = 0
+
+        return self.keys[positions] == keys, positions
+
+    def classify(self, df: pd.DataFrame) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Classifies each row as NEW, AMENDED or UNCHANGED.
+
+        Returns:
+        - np.ndarray: The class of each row.
+        - np.ndarray: datetime64[D] TRANSACTION_DATE each row was last loaded with (NaT for new rows).
+        - np.ndarray: A boolean array, True where a known transaction's row has a later sourceDate than its state.
+        """
+
+        classes = np.full(df.shape[0], NEW, dtype=np.int8)
+        previous_dates = np.full(df.shape[0], np.datetime64("NaT"), dtype="datetime64[D]")
+        newer = np.zeros(df.shape[0], dtype=bool)
+
+        keys, canonical = to_keys(df["transactionId"])
+        found, positions = self.lookup(keys)
+        if not found.any():
+            return classes, previous_dates, newer
+
+        rows = self.load()
+        known = np.flatnonzero(canonical)[found]
+        previous = rows[positions[found]]
+
+        # NaT is stored as the smallest int64, so a row without a valid sourceDate is never newer.
+        newer[known] = parse_dates(df["sourceDate"].iloc[known]).to_numpy(dtype="datetime64[ns]").view("int64") > previous["source_date"]
+        amended = newer[known] & (row_hashes(df.iloc[known]) != previous["row_hash"])
+
+        classes[known] = np.where(amended, AMENDED, UNCHANGED)
+        previous_dates[known] = previous["transaction_date"].astype("datetime64[D]")
+
+        return classes, previous_dates, newer
+
+    def stage(self, df: pd.DataFrame):
+        """
+        Remembers the state of rows about to be loaded; it replaces theirs in the state on commit.
+        """
+
+        if df.shape[0] > 0:
+            self.pending.append(state_rows(df))
+
+    def discard(self):
+
+        self.pending = []
+
+    def commit(self):
+        """
+        Merges the staged rows into the state, the latest staged row of a transaction winning, and writes it atomically.
+        """
+
+        if not self.pending:
+            return
+
+        staged = np.concatenate(self.pending)
+        # np.unique keeps the first occurrence, so it is run on the staged rows in reverse.
+        _, last = np.unique(staged["key"][::-1], return_index=True)
+        staged = staged[::-1][last]
+
+        rows = np.asarray(self.load())
+        rows = np.concatenate([rows[~np.isin(self.keys, staged["key"])], staged])
+        self.write(rows[np.argsort(rows["key"], kind="stable")].astype(STATE_DTYPE))
+        self.pending = []
+
+    def write(self, rows: np.ndarray):
+
+        os.makedirs(os.path.dirname(self.file_w_path), exist_ok=True)
+        tmp_w_path = self.file_w_path + ".tmp"
+
+        with open(tmp_w_path, 'wb') as f:
+            np.save(f, rows)
+        os.replace(tmp_w_path, self.file_w_path)
+
+        self.rows = rows
+        self.keys = np.ascontiguousarray(rows["key"])
+
+
+def get_transaction_state() -> TransactionState:
+    """
+    Returns the process wide transaction state.
+    """
+
+    if "transactions" not in states:
+        states["transactions"] = TransactionState(transaction_state_path)
+
+    return states["transactions"]
+
+
+def classify_transactions(df: pd.DataFrame) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Splits the transactions about to be loaded into the new and the amended ones, dropping the unchanged ones,
+    and stages the state of every row that is newer than the state (including re-sent rows with a later
+    sourceDate but the same content). Returns every row as new, and no amended rows, when
+    use_transaction_state is off.
+
+    Returns:
+    - pd.DataFrame: The new transactions.
+    - pd.DataFrame: The amended transactions, with the date they were last loaded with in previousTransactionDate.
+    """
+
+    if not use_transaction_state:
+        return df, df.iloc[:0]
+
+    state = get_transaction_state()
+    classes, previous_dates, newer = state.classify(df)
+
+    unchanged = classes == UNCHANGED
+    logger = get_run_logger()
+    logger.info(f"transactions: {int((classes == NEW).sum())} new, {int((classes == AMENDED).sum())} amended, "
+                f"{int(unchanged.sum())} unchanged (not sent).",
+                rows_new=int((classes == NEW).sum()), rows_amended=int((classes == AMENDED).sum()), rows_unchanged=int(unchanged.sum()))
+
+    # Rows of a known transaction with a later sourceDate but the same content only move its sourceDate on.
+    state.stage(df[unchanged & newer])
+
+    df_amended = df[classes == AMENDED].copy()
+    df_amended[PREVIOUS_DATE_COLUMN] = previous_dates[classes == AMENDED].astype("datetime64[ns]")
+
+    df_new = df[classes == NEW]
+    state.stage(df_new)
+    state.stage(df_amended)
+
+    return df_new, df_amended
+
+
+def commit_transaction_state():
+    """
+    Writes the staged rows to the state. Call once the database transaction has committed.
+    """
+
+    for state in states.values():
+        state.commit()
+
+
+def discard_transaction_state():
+    """
+    Forgets the staged rows, e.g. after the database transaction was rolled back.
+    """
+
+    for state in states.values():
+        state.discard()
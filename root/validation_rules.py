@@ -0,0 +1,128 @@
+import numpy as np
+import pandas as pd
+from typing import Callable, List, Optional, Tuple, Union
+from compact_schema import (transaction_key, AMOUNT_SCALE)
+from date_parsing import parse_dates
+from config import (date_fmt, allowed_currency, amount_range, allowed_merchant_ids)
+
+
+# Registry of row level validation rules, applied in order by data_validation.apply_validation_rules.
+# Each rule takes the DataFrame and returns a boolean Series that is True for rejected rows
+# (or None if the rule is switched off in config.py). Rules never copy or modify the frame.
+# The error type is either a fixed string or a function of the rejected rows returning one string per row.
+
+ErrorType = Union[str, Callable[[pd.DataFrame], pd.Series]]
+
+VALIDATION_RULES: List[Tuple[str, Callable[[pd.DataFrame], Optional[pd.Series]], ErrorType]] = []
+
+DUPLICATE_ERROR_TYPE = "DUPLICATE VALUE (Removed from final DataFrame)"
+
+
+def register_rule(error_type: ErrorType):
+    """
+    Decorator adding a mask function to VALIDATION_RULES.
+
+    Parameters:
+    - error_type (str or callable): The error type recorded against the rows the rule rejects.
+    """
+
+    def decorator(rule):
+        VALIDATION_RULES.append((rule.__name__, rule, error_type))
+        return rule
+
+    return decorator
+
+
+@register_rule(error_type = lambda df: "INCORRECT CURRENCY = " + df["currency"].astype(str))
+def invalid_currency_mask(df: pd.DataFrame, allowed_currency: List[str] = allowed_currency) -> pd.Series:
+    """
+    Rejects rows whose currency is not one of the allowed currencies.
+    """
+
+    return ~df["currency"].isin(allowed_currency)
+
+
+@register_rule(error_type = "INCORRECT DATE FORMAT")
+def invalid_transaction_date_mask(df: pd.DataFrame, date_fmt: str = date_fmt) -> pd.Series:
+    """
+    Rejects rows whose transactionDate does not match date_fmt (or is NaT, if already parsed).
+    """
+
+    return parse_dates(df["transactionDate"], date_fmt).isna()
+
+
+@register_rule(error_type = "AMOUNT OUT OF RANGE")
+def amount_out_of_range_mask(df: pd.DataFrame, amount_range: Optional[Tuple[float, float]] = amount_range) -> Optional[pd.Series]:
+    """
+    Rejects rows whose amount is missing or outside amount_range (inclusive). Off when amount_range is None.
+    """
+
+    if amount_range is None:
+        return None
+
+    if "amountMinor" in df.columns:
+        amount = df["amountMinor"] / AMOUNT_SCALE
+    else:
+        amount = pd.to_numeric(df["amount"], errors = "coerce")
+    return ~amount.between(*amount_range)
+
+
+@register_rule(error_type = lambda df: "UNKNOWN MERCHANT = " + df["merchantId"].astype(str))
+def unknown_merchant_mask(df: pd.DataFrame, allowed_merchant_ids: Optional[List[int]] = allowed_merchant_ids) -> Optional[pd.Series]:
+    """
+    Rejects rows whose merchantId is not whitelisted. Off when allowed_merchant_ids is None.
+    """
+
+    if allowed_merchant_ids is None:
+        return None
+
+    return ~df["merchantId"].isin(allowed_merchant_ids)
+
+
+def duplicate_mask(df: pd.DataFrame, candidates: Optional[pd.Series] = None, source_date: Optional[pd.Series] = None) -> pd.Series:
+    """
+    Marks the duplicate transactions to remove: for each transactionId among the candidate rows, every row
+    except the one with the latest sourceDate. Ties on sourceDate keep the row that comes last in the file,
+    and an unparseable sourceDate counts as older than any valid one.
+
+    Only transactionIds occurring more than once (found by hashing) are resolved, with a single integer
+    sort of (transactionId code, sourceDate, row position); the frame itself is never sorted or compared cell-wise.
+
+    Parameters:
+    - df (pd.DataFrame): The DataFrame to check.
+    - candidates (pd.Series): Boolean mask of the rows taking part (e.g. those passing every other rule).
+      Defaults to all rows.
+    - source_date (pd.Series): The already parsed sourceDate column, if the caller has it.
+
+    Returns:
+    - pd.Series: Boolean mask, True for the duplicate rows to remove.
+    """
+
+    mask = np.zeros(df.shape[0], dtype = bool)
+
+    positions = np.arange(df.shape[0]) if candidates is None else np.flatnonzero(candidates.to_numpy())
+    transaction_ids = transaction_key(df)[positions]
+
+    is_duplicated = pd.Series(transaction_ids).duplicated(keep = False).to_numpy()
+    if not is_duplicated.any():
+        return pd.Series(mask, index = df.index)
+
+    positions = positions[is_duplicated]
+
+    if source_date is None:
+        source_date = parse_dates(df["sourceDate"].iloc[positions])
+    else:
+        source_date = source_date.iloc[positions]
+
+    # NaT is stored as the smallest int64, so it sorts before every valid date.
+    timestamps = source_date.to_numpy(dtype = "datetime64[ns]").view("int64")
+    codes, _ = pd.factorize(transaction_ids[is_duplicated])
+
+    # Sort by transactionId, then sourceDate, then position; the last row of each group is kept.
+    order = np.lexsort((positions, timestamps, codes))
+    sorted_codes = codes[order]
+    is_last = np.append(sorted_codes[1:] != sorted_codes[:-1], True)
+
+    mask[positions[order[~is_last]]] = True
+
+    return pd.Series(mask, index = df.index)